@@ -1,7 +1,17 @@
 import os
+import time
+import shutil
 import subprocess
+import hashlib
 import boto3
 import json
+from result_cache import ResultCache
+import metrics
+import s3_transfer
+from scheduler import JobScheduler
+import run
+import scratch
+import ref_index
 
 # Get configuration
 from configparser import ConfigParser
@@ -14,47 +24,337 @@ class Annotator:
     def __init__(self):
         self.sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
         self.url = config['sqs']['RequestUrl']
+        self.cache = None
+        if config.getboolean('cache', 'Enabled', fallback=False):
+            self.cache = ResultCache(config['cache']['ResultsIndex'])
+        self.metrics = metrics.from_config(config)
+        self.references = ref_index.ReferenceIndexes(
+            config.get('reference', 'Root', fallback=None),
+            config['anntools']['ReferenceVersion'],
+            {'dbsnp_filter': config.get('anntools', 'DbSnpFilter', fallback=None)},
+            workers=config.getint('reference', 'LoadWorkers', fallback=4))
+        self.reference_check_interval = config.getint('reference',
+            'CheckInterval', fallback=60)
+        self.reference_checked = 0
+        self.jobs = {}
+        self.records_total = 0
+        self.annotation_seconds_total = 0.0
+        #Small and large inputs are scheduled separately, each with its own
+        #slots, so small jobs never wait behind large ones
+        weights = {
+            'premium': config.getint('scheduler', 'PremiumWeight', fallback=3),
+            'free': config.getint('scheduler', 'FreeWeight', fallback=1)
+        }
+        self.schedulers = {
+            'small': JobScheduler(
+                slots=config.getint('scheduler', 'Slots', fallback=4),
+                weights=weights,
+                reserved={'premium': config.getint('scheduler',
+                    'PremiumReservedSlots', fallback=1)}),
+            'large': JobScheduler(
+                slots=config.getint('scheduler', 'LargeSlots', fallback=1),
+                weights=weights,
+                reserved={'premium': config.getint('scheduler',
+                    'LargePremiumReservedSlots', fallback=0)})
+        }
+        self.large_job_bytes = config.getint('scheduler', 'LargeJobBytes',
+            fallback=50 * 1024 * 1024)
+        self.large_job_shards = config.getint('scheduler', 'LargeJobShards',
+            fallback=4)
+        self.prefetch = config.getint('scheduler', 'Prefetch', fallback=20)
+        self.large_prefetch = config.getint('scheduler', 'LargePrefetch',
+            fallback=2)
+        self.large_requeue_delay = config.getint('scheduler',
+            'LargeRequeueDelay', fallback=60)
+        self.visibility_timeout = config.getint('scheduler',
+            'VisibilityTimeout', fallback=300)
+        self.max_attempts = config.getint('scheduler', 'MaxAttempts',
+            fallback=3)
+        #Scratch directories of jobs killed without cleaning up
+        scratch.sweep(scratch.scratch_root(
+            config.get('scratch', 'Root', fallback=None),
+            'ann/anntools/data/jobs/scratch'))
+
+
+    @property
+    def reference_version(self):
+        return self.references.current.version
+
+
+    def load_references(self):
+        #Map and validate every reference index before taking any job; retry
+        #until they load so a bad index never reaches a job
+        self.metrics.gauge('reference_ready', 0)
+        while True:
+            try:
+                self.references.load()
+                break
+            except Exception as e:
+                print(f'Reference indexes not ready, retrying: {e}')
+                time.sleep(self.reference_check_interval)
+        self.report_references(self.references.current)
+
+
+    def check_references(self):
+        #Swap in a newly published reference version once it has loaded
+        if time.time() - self.reference_checked < self.reference_check_interval:
+            return
+        self.reference_checked = time.time()
+        swapped = self.references.check()
+        if swapped is not None:
+            self.report_references(swapped)
+
+
+    def report_references(self, references):
+        print(f'Reference {references.version} ready: {len(references.loaded)} '
+            f'indexes, {references.footprint()} bytes mapped in '
+            f'{references.load_seconds:.1f}s')
+        self.metrics.gauge('reference_ready', 1)
+        self.metrics.gauge('reference_load_seconds',
+            round(references.load_seconds, 3))
+        self.metrics.gauge('reference_index_bytes', references.footprint())
 
 
     def SQS_message_reciever(self):
+        self.load_references()
         print(f'SQS Message Reciever Listening on {self.url}')
         while True:
+            self.check_references()
+            self.report_load()
+            self.dispatch()
+            self.keep_buffered_visible()
+
+            #Buffer at most Prefetch small jobs locally (large ones have their
+            #own limit, see enqueue); only wait long on the queue when there
+            #is nothing to dispatch or reap
+            room = self.prefetch - self.schedulers['small'].pending()
+            if room <= 0:
+                time.sleep(1)
+                continue
+            idle = self.pending() == 0 and len(self.jobs) == 0
             #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/receive_message.html
             sqs_response = self.sqs.receive_message(
                 QueueUrl=self.url, 
-                MaxNumberOfMessages=10,
+                MaxNumberOfMessages=min(10, room),
                 AttributeNames=['All'],
-                WaitTimeSeconds=20
+                WaitTimeSeconds=20 if idle else 1
                 )
             
             if 'Messages' in sqs_response:
                 for msg in sqs_response['Messages']:
-                    msg_body = json.loads(msg['Body'])
-                    print(f"Received message: {msg_body}")
-                    message_id = msg['MessageId']
-                    success = self.process_message(msg_body)
-                    if success:
-                        receipt = msg['ReceiptHandle']
-                        self.sqs.delete_message(
-                            QueueUrl=self.url,
-                            ReceiptHandle=receipt
-                        )
-                        print(f'Message {message_id} Deleted from Queue')
-
-
-    def process_message(self, msg):
+                    self.enqueue(msg)
+            self.dispatch()
+
+
+    def pending(self):
+        return sum(scheduler.pending() for scheduler in self.schedulers.values())
+
+
+    def enqueue(self, msg):
+        #Queue a received message by input size and in the premium or free lane
+        msg_body = json.loads(msg['Body'])
+        print(f"Received message: {msg_body}")
+        try:
+            msg_content = json.loads(msg_body['Message'])
+        except Exception:
+            msg_content = {}
+        lane = 'premium' if msg_content.get('user_role') == 'premium_user' else 'free'
+        size = self.input_size(msg_content)
+        size_class = 'large' if size >= self.large_job_bytes else 'small'
+        scheduler = self.schedulers[size_class]
+        if size_class == 'large' and scheduler.pending() >= self.large_prefetch:
+            #Leave it in the queue for a while (or for another annotator)
+            #rather than let large jobs fill the local buffer
+            try:
+                self.sqs.change_message_visibility(
+                    QueueUrl=self.url,
+                    ReceiptHandle=msg['ReceiptHandle'],
+                    VisibilityTimeout=self.large_requeue_delay
+                )
+            except Exception as e:
+                print(f"Could not requeue {msg['MessageId']}: {e}")
+            return
+        scheduler.submit(lane, {'msg': msg, 'body': msg_body,
+            'visible_until': time.time() + self.visibility_timeout})
+        self.metrics.gauge(f'{size_class}_{lane}_pending', scheduler.pending(lane))
+
+
+    def input_size(self, msg_content):
+        #Size of the input object from a HEAD request; 0 if it cannot be read
+        #(the download will then fail and report the error as before)
+        try:
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/head_object.html
+            response = s3_transfer.s3_client().head_object(Bucket=msg_content['s3_inputs_bucket'],
+                Key=msg_content['s3_key_input_file'])
+            return response['ContentLength']
+        except Exception as e:
+            print(f'Could not read input size: {e}')
+            return 0
+
+
+    def dispatch(self):
+        #Start queued jobs while the schedulers have slots for them
+        for size_class, scheduler in self.schedulers.items():
+            self.dispatch_class(size_class, scheduler)
+
+
+    def dispatch_class(self, size_class, scheduler):
+        while True:
+            running = {lane: 0 for lane in scheduler.lanes}
+            for job in self.jobs.values():
+                if job['size_class'] == size_class:
+                    running[job['lane']] += 1
+            job = scheduler.next_job(running)
+            if job is None:
+                break
+            lane, item, waited = job
+            self.metrics.observe(f'{lane}_wait_seconds', waited)
+            self.metrics.gauge(f'{size_class}_{lane}_pending', scheduler.pending(lane))
+
+            success = self.process_message(item['body'], lane, size_class)
+            if not success:
+                continue
+            job_id = json.loads(item['body']['Message'])['job_id']
+            if job_id in self.jobs:
+                #Deleted once the run completes; if this instance dies first
+                #SQS redelivers it and the job resumes from its checkpoint
+                self.jobs[job_id]['item'] = item
+            else:
+                self.delete_message(item['msg'])
+
+
+    def delete_message(self, msg):
+        self.sqs.delete_message(
+            QueueUrl=self.url,
+            ReceiptHandle=msg['ReceiptHandle']
+        )
+        print(f"Message {msg['MessageId']} Deleted from Queue")
+
+
+    def keep_buffered_visible(self):
+        #Messages waiting in a lane or for a running job are still in flight
+        #in SQS; extend their visibility so they are not redelivered
+        now = time.time()
+        items = [item for scheduler in self.schedulers.values()
+            for item in scheduler.items()]
+        items.extend([job['item'] for job in self.jobs.values() if 'item' in job])
+        for item in items:
+            if item['visible_until'] - now > self.visibility_timeout / 2:
+                continue
+            try:
+                #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+                self.sqs.change_message_visibility(
+                    QueueUrl=self.url,
+                    ReceiptHandle=item['msg']['ReceiptHandle'],
+                    VisibilityTimeout=self.visibility_timeout
+                )
+                item['visible_until'] = now + self.visibility_timeout
+            except Exception as e:
+                print(f"Could not extend visibility of {item['msg']['MessageId']}: {e}")
+
+
+    def report_load(self):
+        #Reap finished anntools runs, then publish load for autoscaling
+        for job_id, job in list(self.jobs.items()):
+            if job['proc'].poll() is None:
+                continue
+            del self.jobs[job_id]
+            returncode = job['proc'].returncode
+            self.record_job_stats(job_id, time.time() - job['started'], returncode)
+            if 'item' not in job:
+                continue
+            if returncode == 0:
+                try:
+                    self.delete_message(job['item']['msg'])
+                except Exception as e:
+                    print(f'Could not delete message for job {job_id}: {e}')
+            elif job['attempts'] >= self.max_attempts:
+                #Out of attempts: a job that keeps failing is not redelivered
+                self.fail_job(job_id)
+                try:
+                    self.delete_message(job['item']['msg'])
+                except Exception as e:
+                    print(f'Could not delete message for job {job_id}: {e}')
+
+        try:
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/get_queue_attributes.html
+            attributes = self.sqs.get_queue_attributes(
+                QueueUrl=self.url,
+                AttributeNames=['ApproximateNumberOfMessages',
+                    'ApproximateNumberOfMessagesNotVisible']
+                )['Attributes']
+            queue_depth = int(attributes['ApproximateNumberOfMessages'])
+            self.metrics.gauge('queue_depth', queue_depth)
+            self.metrics.gauge('queue_in_flight_messages',
+                int(attributes['ApproximateNumberOfMessagesNotVisible']))
+        except Exception as e:
+            print(f'Could not read queue depth: {e}')
+            queue_depth = None
+        self.metrics.gauge('jobs_in_flight', len(self.jobs))
+        self.metrics.gauge('jobs_buffered', self.pending())
+
+        #Expected time to drain the queue at the observed per-job cost and
+        #current concurrency; the n-th queued job completes after ~n/depth of it
+        job_seconds = self.metrics.mean('job_seconds')
+        if queue_depth is not None and job_seconds is not None:
+            self.metrics.gauge('backlog_seconds',
+                round(queue_depth * job_seconds / max(1, len(self.jobs)), 2))
+
+
+    def record_job_stats(self, job_id, elapsed, returncode):
+        self.metrics.observe('job_seconds', elapsed)
+        if returncode != 0:
+            self.metrics.incr('jobs_failed')
+            return
+        self.metrics.incr('jobs_completed')
+        stats_path = os.path.join('ann/anntools/data/jobs', f'{job_id}.stats.json')
+        try:
+            with open(stats_path) as f:
+                stats = json.load(f)
+            os.remove(stats_path)
+        except Exception as e:
+            print(f'No job stats for {job_id}: {e}')
+            return
+        self.metrics.incr('records_annotated', stats['records'] or 0)
+        if stats.get('scratch_peak_bytes') is not None:
+            self.metrics.observe('scratch_peak_bytes',
+                stats['scratch_peak_bytes'])
+        if stats['records'] and stats['seconds'] > 0:
+            self.metrics.observe('annotation_seconds', stats['seconds'])
+            self.records_total += stats['records']
+            self.annotation_seconds_total += stats['seconds']
+            self.metrics.gauge('records_per_second', round(
+                self.records_total / self.annotation_seconds_total, 2))
+
+
+    def process_message(self, msg, lane='free', size_class='small'):
         msg_content = json.loads(msg['Message'])
         job_id = msg_content['job_id']
         bucket = msg_content['s3_inputs_bucket']
         object_key = msg_content['s3_key_input_file']
         
         try:
-            self.S3_download(job_id, bucket, object_key)
+            input_hash = self.S3_download(job_id, bucket, object_key)
         except Exception as e:
             print(f'Failed to download file from S3: {e}')
             return False
+
+        #Save job details for run.py
+        msg_content['input_hash'] = input_hash
+        msg_content['reference_version'] = self.reference_version
+        msg_content['reference_indexes'] = self.references.current.paths()
+        with open(os.path.join('ann/anntools/data/jobs', f'{job_id}.json'), 'w') as f:
+            json.dump(msg_content, f)
+
+        if self.cache is not None:
+            try:
+                if self.reuse_cached_result(msg_content):
+                    return True
+            except Exception as e:
+                print(f'Results index lookup failed: {e}')
+
         try:
-            self.run_anntools(job_id)
+            self.run_anntools(job_id, lane, size_class)
         except Exception as e:
             print(f'Failed to run anntools: {e}')
             return False
@@ -63,20 +363,83 @@ class Annotator:
 
 
     def S3_download(self, job_id, bucket, object_key):
-        #Download Annotation Files From S3
-        s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+        #Download Annotation Files From S3 (parallel multipart for large
+        #inputs), hashing the content as it is written
         os.makedirs('ann/anntools/data/jobs', exist_ok=True)
         download_path = os.path.join('ann/anntools/data/jobs', f'{job_id}.vcf')
+        digest = hashlib.sha256()
         
         try:
-            #https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-example-download-file.html
-            s3.download_file(bucket, object_key, download_path)
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_fileobj.html
+            s3_transfer.download(bucket, object_key, download_path,
+                on_chunk=digest.update)
             print('Download from S3 Successful')
         except Exception as e:
             print(f'Download from S3 Failed: {e}')
+            raise
+
+        return digest.hexdigest()
 
 
-    def run_anntools(self, job_id):
+    def reuse_cached_result(self, job):
+        #Copy a previous annotation of identical input instead of recomputing
+        cached = self.cache.lookup(job['input_hash'], self.reference_version)
+        if cached is None:
+            return False
+
+        job_id = job['job_id']
+        folder_prefix = config['s3']['FolderPrefix']
+        bucket = config['s3']['ResultsBucket']
+        s3_key_result = f"{folder_prefix}/{job['user_id']}/{job_id}.annot.vcf"
+        s3_key_log = f"{folder_prefix}/{job['user_id']}/{job_id}.vcf.count.log"
+
+        try:
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/copy.html
+            s3_transfer.copy(cached['bucket'], cached['s3_key_result_file'],
+                bucket, s3_key_result)
+            s3_transfer.copy(cached['bucket'], cached['s3_key_log_file'],
+                bucket, s3_key_log)
+        except Exception as e:
+            #Cached objects may since have been archived or deleted
+            print(f'Cached result unavailable, annotating: {e}')
+            self.cache.forget(job['input_hash'], self.reference_version)
+            return False
+        print(f"Reused cached result {cached['s3_key_result_file']} for job {job_id}")
+
+        #Results annotated before indexes were written have none
+        s3_key_index = f'{s3_key_result}.idx'
+        try:
+            s3_transfer.copy(cached['bucket'], cached['s3_key_result_file'] + '.idx',
+                bucket, s3_key_index)
+        except Exception as e:
+            print(f'No result index to reuse: {e}')
+            s3_key_index = None
+
+        dynamo = boto3.resource('dynamodb')
+        table = dynamo.Table(config['dynamo']['Table'])
+        run.complete_job(table, job_id, bucket, s3_key_result, s3_key_log,
+            s3_key_index)
+        self.cache.record(job['input_hash'], self.reference_version,
+            bucket, s3_key_result, s3_key_log)
+
+        self.remove_job_files(job_id)
+        return True
+
+
+    def remove_job_files(self, job_id):
+        for path in [f'{job_id}.vcf', f'{job_id}.json']:
+            try:
+                os.remove(os.path.join('ann/anntools/data/jobs', path))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f'Could Not Delete File: {e}')
+        #Local checkpoint of a job that will not run again
+        shutil.rmtree(os.path.join('ann/anntools/data/jobs/checkpoints', job_id),
+            ignore_errors=True)
+
+
+    def run_anntools(self, job_id, lane='free', size_class='small'):
         download_path = os.path.join('ann/anntools/data/jobs', f'{job_id}.vcf')
         #Run anntools on input file and update job status to running
         dynamo = boto3.resource('dynamodb')
@@ -84,14 +447,36 @@ class Annotator:
         try:
             #https://stackoverflow.com/questions/63418641/dynamodb-boto3-conditional-update
             #HW4-4
-            table.update_item(
+            #A redelivered job is already RUNNING and resumes from its checkpoint;
+            #run_attempts counts the runs started, whoever started them
+            response = table.update_item(
                 Key={'job_id': job_id},
-                UpdateExpression='set job_status = :new',
-                ExpressionAttributeValues={':new':'RUNNING', ':current':'PENDING'},
-                ConditionExpression='job_status = :current',
+                UpdateExpression='set job_status = :new add run_attempts :one',
+                ExpressionAttributeValues={':new':'RUNNING', ':current':'PENDING',
+                    ':one': 1},
+                ConditionExpression='job_status IN (:current, :new)',
                 ReturnValues="UPDATED_NEW"
                 )
-            subprocess.Popen(['python3', 'ann/run.py', download_path])
+        except Exception as e:
+            #Already completed (or failed): nothing to run
+            print(f'Job {job_id} is no longer pending or running: {e}')
+            self.remove_job_files(job_id)
+            return
+        attempts = int(response['Attributes']['run_attempts'])
+        if attempts > self.max_attempts:
+            #Earlier runs died without reporting (e.g. the instance was lost);
+            #the message is deleted once this returns
+            self.fail_job(job_id)
+            return
+        self.publish_status(job_id, 'RUNNING')
+
+        try:
+            command = ['python3', 'ann/run.py', download_path]
+            if size_class == 'large':
+                command.append(str(self.large_job_shards))
+            proc = subprocess.Popen(command)
+            self.jobs[job_id] = {'proc': proc, 'started': time.time(),
+                'lane': lane, 'size_class': size_class, 'attempts': attempts}
         except Exception as e:
             table.update_item(
                 Key={'job_id': job_id},
@@ -105,6 +490,43 @@ class Annotator:
         print('Job Posted to Anntools')
 
 
+    def fail_job(self, job_id):
+        #Give up on a job after MaxAttempts runs: mark it FAILED and tell the
+        #web server; the caller deletes the message so SQS stops redelivering
+        print(f'Job {job_id} failed {self.max_attempts} times, giving up')
+        dynamo = boto3.resource('dynamodb')
+        table = dynamo.Table(config['dynamo']['Table'])
+        try:
+            table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='set job_status = :failed',
+                ExpressionAttributeValues={':failed': 'FAILED',
+                    ':running': 'RUNNING'},
+                ConditionExpression='job_status = :running'
+                )
+            self.publish_status(job_id, 'FAILED')
+        except Exception as e:
+            print(f'Could not mark job {job_id} failed: {e}')
+        self.remove_job_files(job_id)
+
+
+    def publish_status(self, job_id, status):
+        #Lets the web server push the transition to open job pages
+        topic = config.get('sns', 'SnsStatusTopic', fallback='')
+        if not topic:
+            return
+        try:
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+            boto3.client('sns', region_name=config['aws']['AwsRegionName']).publish(
+                TopicArn=topic,
+                Message=json.dumps({'default': json.dumps(
+                    {'job_id': job_id, 'job_status': status})}),
+                MessageStructure='json'
+            )
+        except Exception as e:
+            print(f'Unable to publish status of job {job_id}: {e}')
+
+
 if __name__ == '__main__':
     annot = Annotator()
     annot.SQS_message_reciever()
\ No newline at end of file
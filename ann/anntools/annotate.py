@@ -10,8 +10,11 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import pymysql.cursors
+
 import file_utils as fu
 import utils as u
+import sweep as sw
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -93,6 +96,107 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+"""Point-in-interval lookups against a region table
+   Default (point) mode runs one query per variant, as the stages always
+   did. In sweep mode the table is streamed one chromosome at a time,
+   ordered by start, and each variant is answered from the active-interval
+   heap of sweep.IntervalSweep, so a position-sorted input costs a single
+   linear merge-join per chromosome. Variants that arrive out of order
+   (or on a chromosome already swept past) fall back to a point query, so
+   results never depend on the input being sorted.
+   rows() keeps the "all matches" (fetchall) semantics and first() the
+   "first match only" (fetchone) semantics of the stages.
+"""
+class RegionLookup(object):
+
+    def __init__(self, conn, table, chromCol='chrom', startExpr='chromStart',
+        endExpr='chromEnd', columns='*', sweep=False, stream_conn=None):
+        self.cursor = conn.cursor()
+        self.table = table
+        self.chromCol = chromCol
+        self.startExpr = startExpr
+        self.endExpr = endExpr
+        self.columns = columns
+        self.sweep = sweep
+        self.stream_conn = stream_conn
+        self.own_stream_conn = False
+        self.stream_cursor = None
+        self.sweeper = None
+        self.chrom = None
+        self.done = set()
+
+    """Rows containing pos in table order (the stages' original query), or
+       ordered by start like the sweep stream when ordered is set
+    """
+    def pointQuery(self, chr, pos, ordered=False):
+        sql = 'select ' + self.columns + ' from ' + self.table + ' where '
+        if self.chromCol is not None:
+            sql = sql + self.chromCol + '="' + str(chr) + '" AND '
+        sql = sql + '(' + self.startExpr + ' <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= ' + self.endExpr + ')'
+        if ordered:
+            sql = sql + ' order by ' + self.startExpr
+        self.cursor.execute(sql + ';')
+        return list(self.cursor.fetchall())
+
+    """Streams (start, end, row) for one chromosome, ordered by start
+    """
+    def stream(self, chr):
+        if self.stream_conn is None:
+            self.stream_conn = u.db_connect(cursorclass=pymysql.cursors.SSCursor)
+            self.own_stream_conn = True
+
+        sql = 'select ' + self.columns + ', ' + self.startExpr + ', ' + \
+            self.endExpr + ' from ' + self.table
+        if self.chromCol is not None:
+            sql = sql + ' where ' + self.chromCol + '="' + str(chr) + '"'
+        sql = sql + ' order by ' + self.startExpr + ';'
+
+        self.stream_cursor = self.stream_conn.cursor()
+        self.stream_cursor.execute(sql)
+        for row in self.stream_cursor:
+            yield (int(row[-2]), int(row[-1]), tuple(row[:-2]))
+
+    def closeStream(self):
+        if self.stream_cursor is not None:
+            self.stream_cursor.close()
+            self.stream_cursor = None
+        if self.chrom is not None:
+            self.done.add(self.chrom)
+        self.sweeper = None
+        self.chrom = None
+
+    def rows(self, chr, pos):
+        pos = int(pos)
+        if not self.sweep:
+            return self.pointQuery(chr, pos)
+
+        if (chr != self.chrom):
+            self.closeStream()
+            # Fallbacks within a sweep keep the stream's order, so a record's
+            # first match does not depend on where it sits in the file
+            if chr in self.done:
+                return self.pointQuery(chr, pos, ordered=True)
+            self.chrom = chr
+            self.sweeper = sw.IntervalSweep(self.stream(chr))
+
+        if not self.sweeper.canAdvance(pos):
+            return self.pointQuery(chr, pos, ordered=True)
+        return self.sweeper.overlapping(pos)
+
+    def first(self, chr, pos):
+        rows = self.rows(chr, pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+    def close(self):
+        self.closeStream()
+        if self.own_stream_conn:
+            self.stream_conn.close()
+            self.stream_conn = None
+
+
 def getComplementary(nuc):
     compNuc = ''
     if (str(nuc) == 'A'):
@@ -109,13 +213,20 @@ def getComplementary(nuc):
 
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+    With bloom (a bloom.BloomFilter over dbSNP positions) records whose
+    position is definitely not in dbSNP are not queried; skipped queries
+    and the observed false positive rate are written to the count log. A
+    false positive is a position the filter let through that dbSNP does not
+    have at all (a position with other alleles is a true hit)
 """ 
 def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
+    varclass='SNV', sep='\t', bloom=None):
     
-    outfile = vcf + tmpextout
+    basefile = vcf
+    vcf = basefile + tmpextin
+    outfile = basefile + tmpextout
     fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
+    logcountfile = basefile + '.count.log'
     fh_log = open(logcountfile, 'w')
     var_count = 0
 
@@ -125,6 +236,9 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     conn = u.db_connect()
     cursor = conn.cursor()
     linenum = 1
+    skipped = 0
+    queried = 0
+    false_positives = 0
 
     for line in fh:
         line = line.strip()
@@ -141,12 +255,23 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
             compRef = getComplementary(ref)
             compAlt = getComplementary(alt)
 
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            if (bloom is not None) and not bloom.mightContain(chr, pos):
+                rows = []
+                skipped = skipped + 1
+            else:
+                sql = 'select * from dbSNP where CHR="' + str(chr) + \
+                    '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+                    '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+                    varclass + '" ;'
+                cursor.execute(sql)
+                rows = cursor.fetchall()
+                queried = queried + 1
+                if (bloom is not None) and (len(rows) == 0):
+                    cursor.execute('select 1 from dbSNP where CHR="' + \
+                        str(chr) + '" AND POS=' + str(pos) + \
+                        ' AND INFO = "' + varclass + '" limit 1;')
+                    if cursor.fetchone() is None:
+                        false_positives = false_positives + 1
 
             fields[2] = '.'
             rsids = []
@@ -185,6 +310,11 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
     fh_log.write(f"Total: {str(linenum)}\n")
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
+    if bloom is not None:
+        fpRate = (false_positives / float(max(1, false_positives + skipped))) * 100
+        fh_log.write(f"## dbSNP filter: {str(skipped)} queries skipped, " + \
+            f"{str(queried)} sent, {str(false_positives)} false positives " + \
+            f"({str(round(fpRate, 2))}% of non-dbSNP positions)\n")
     fh_log.close()
 
     conn.close()
@@ -305,7 +435,7 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
 """Get information about location in gene structures
 """
 def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -329,6 +459,9 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh = open(vcf)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, 
+        startExpr='(txStart - ' + str(promoter_offset) + ')',
+        endExpr='(txEnd + ' + str(promoter_offset) + ')', sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -344,37 +477,31 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
             info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+            info_values = u.parse_info(info_field)
+            this_gene_name = info_values.get('name', '.')
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            rows = lookup.rows(chr, pos)
             info = []
 
             if (len(rows) > 0):
+                #count location once for every transcript
+                positionType = info_values.get('positionType', '.')
+                n = len(rows)
+                if (positionType == 'intron'):
+                    intronic_count = intronic_count + n
+                elif (positionType == 'non_coding_intron'):
+                    non_coding_intronic_count = non_coding_intronic_count + n
+                elif (positionType == 'CDS'):
+                    cds_count = cds_count + n
+                elif (positionType == 'non_coding_exon'):
+                    non_coding_exonic_count = non_coding_exonic_count + n
+                elif (positionType == 'utr5'):
+                    utr5_count = utr5_count + n
+                elif (positionType == 'utr3'):
+                    utr3_count = utr3_count + n
+
                 cnt = 1
                 for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
                     txtStart = int(row[4])
                     txtEnd = int(row[5])
                     cdsStart = int(row[6])
@@ -498,6 +625,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
+    lookup.close()
     conn.close()
 
 
@@ -543,7 +671,8 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             ref = clean_mysql_chars(fields[inds[2]]).strip()
             alt = clean_mysql_chars(fields[inds[3]]).strip()
             info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
+            info_values = u.parse_info(info_field)
+            this_gene_name = info_values.get('name', '.')
 
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
                 '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
@@ -715,7 +844,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 """Overlap with tfbsConsSites
 """
 def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
+    tmpextin='.2', tmpextout='.3', sep='\t', sweep=False):
 
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
@@ -735,6 +864,12 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    # One table per chromosome; the lookups share one streaming connection
+    stream_conn = None
+    if sweep:
+        stream_conn = u.db_connect(cursorclass=pymysql.cursors.SSCursor)
+    lookups = {}
+    lookup = None
 
     linenum = 1
     for line in fh:
@@ -760,12 +895,15 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 
             if (chrIndex in allowed_chrom):
                 isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                if chrIndex not in lookups:
+                    lookups[chrIndex] = RegionLookup(conn, 
+                        'tfbsConsSites' + chrIndex, chromCol=None,
+                        columns='chrom, chromStart, chromEnd, name',
+                        sweep=sweep, stream_conn=stream_conn)
+                if (lookup is not None) and (lookup is not lookups[chrIndex]):
+                    lookup.closeStream()
+                lookup = lookups[chrIndex]
+                rows = lookup.rows(chr, pos)
                 records = []
 
                 if (len(rows) > 0):
@@ -799,6 +937,10 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    for l in lookups.values():
+        l.close()
+    if stream_conn is not None:
+        stream_conn.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -807,7 +949,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
 """Overlap with GadAll table
 """
 def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
+    tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -824,6 +966,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, chromCol='chromosome', sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -843,11 +986,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lookup.rows(chr, pos)
                 records = []
 
                 if (len(rows) > 0):
@@ -876,6 +1015,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -883,7 +1023,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
 
 """ Overlap with gwasCatalog table """
 def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -900,6 +1040,8 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, startExpr='chromEnd',
+        endExpr='chromEnd', sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -918,10 +1060,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
                 pos = fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lookup.rows(chr, pos)
                 records = []
 
                 if (len(rows) > 0):
@@ -948,6 +1087,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -956,7 +1096,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
 def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -973,6 +1113,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -991,11 +1132,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
                 pos=fields[inds[1]].strip()
                 isOverlap = False
 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lookup.rows(chr, pos)
                 records = []
 
                 if (len(rows) > 0):
@@ -1028,6 +1165,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -1036,7 +1174,8 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
 """Overlap with segdup regions genomicSuperDups
 """
 def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t',
+    sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1053,6 +1192,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -1075,11 +1215,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
                 otherEnd = ''
                 l = str(isOverlap)
 
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lookup.first(chr, pos)
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1103,6 +1239,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -1112,7 +1249,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
    with which SNP or INDEL overlaps
 """
 def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1134,6 +1271,8 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, startExpr=startName,
+        endExpr=endName, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -1152,12 +1291,8 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
                 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lookup.rows(chr, pos)
 
                 if (len(rows) > 0):
                     line_count = line_count + 1
@@ -1182,6 +1317,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -1190,7 +1326,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
 """Method to find overlap with Cytoband table
 """
 def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1214,6 +1350,8 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, startExpr=startName,
+        endExpr=endName, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -1232,12 +1370,8 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
                 pos = fields[inds[1]].strip()
                 isOverlap = False
                 
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
                 overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
+                rows = lookup.rows(chr, pos)
 
                 if (len(rows) > 0):
                     line_count = line_count + 1
@@ -1261,6 +1395,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -1269,7 +1404,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
 """Method to find overlap with CNV tables
 """
 def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1286,6 +1421,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -1303,11 +1439,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
 
                 pos = fields[inds[1]].strip()
                 isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lookup.first(chr, pos)
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1329,6 +1461,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
@@ -1337,7 +1470,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
 """Method to find overlap with targetScanS tables
 """
 def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
+    tmpextin='', tmpextout='.1', sep='\t', sweep=False):
     
     basefile = vcf
     vcf = basefile + tmpextin
@@ -1354,6 +1487,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
     inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
     cursor = conn.cursor()
+    lookup = RegionLookup(conn, table, sweep=sweep)
     linenum = 1
 
     for line in fh:
@@ -1370,11 +1504,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
                     chr = "chr" + chr
 
                 pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
+                rows = lookup.first(chr, pos)
 
                 if rows is not None:
                     line_count = line_count + 1
@@ -1396,6 +1526,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
+    lookup.close()
     conn.close()
     fh.close()
     fh_out.close()
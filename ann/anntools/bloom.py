@@ -0,0 +1,172 @@
+# bloom.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Bloom filter over dbSNP (chrom, pos), used to rule out definite misses
+# locally before querying the reference database
+#
+# The filter file is a small fixed header followed by the bit array. It is
+# memory-mapped read-only, so every process that opens it shares the same
+# pages through the OS page cache.
+#
+# To build: python bloom.py <output_file> [false_positive_rate]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import math
+import mmap
+import struct
+import hashlib
+
+MAGIC = b'ANNBLOOM'
+HEADER = struct.Struct('<8sQQQd')   # magic, nbits, nhashes, nitems, fp rate
+FP_RATE = 0.01
+
+
+"""Filter key for a variant position; "chr" prefix is ignored
+"""
+def positionKey(chrom, pos):
+    c = str(chrom).strip()
+    if c.startswith('chr'):
+        c = c.replace('chr', '')
+    return (c + ':' + str(pos).strip()).encode('utf-8')
+
+
+"""Bit positions of a key (double hashing over one blake2b digest)
+"""
+def bitIndices(key, nbits, nhashes):
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % nbits for i in range(nhashes)]
+
+
+"""Filter size for nitems at the given false positive rate
+"""
+def optimalSize(nitems, fp_rate=FP_RATE):
+    nitems = max(1, nitems)
+    nbits = int(math.ceil(-nitems * math.log(fp_rate) / (math.log(2) ** 2)))
+    nhashes = max(1, int(round((float(nbits) / nitems) * math.log(2))))
+    return (nbits, nhashes)
+
+
+class BloomFilter(object):
+
+    def __init__(self, bits, nbits, nhashes, nitems=0, fp_rate=FP_RATE):
+        self.bits = bits
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.nitems = nitems
+        self.fp_rate = fp_rate
+        self.fh = None
+
+
+    """Empty, writable filter sized for nitems
+    """
+    @classmethod
+    def create(cls, nitems, fp_rate=FP_RATE):
+        nbits, nhashes = optimalSize(nitems, fp_rate)
+        return cls(bytearray((nbits + 7) // 8), nbits, nhashes, 0, fp_rate)
+
+
+    """Read-only, memory-mapped filter from a file written by save
+    """
+    @classmethod
+    def load(cls, path):
+        fh = open(path, 'rb')
+        try:
+            bits = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            fh.close()
+            raise
+        magic, nbits, nhashes, nitems, fp_rate = HEADER.unpack_from(bits, 0)
+        if (magic != MAGIC) or (len(bits) < HEADER.size + (nbits + 7) // 8):
+            bits.close()
+            fh.close()
+            raise ValueError(f'Not a valid Bloom filter file: {path}')
+        bloom = cls(memoryview(bits)[HEADER.size:], nbits, nhashes,
+            nitems, fp_rate)
+        bloom.mapping = bits
+        bloom.fh = fh
+        return bloom
+
+
+    """Asks the OS to read the whole mapped filter into the page cache
+    """
+    def warm(self):
+        if (self.fh is not None) and hasattr(mmap, 'MADV_WILLNEED'):
+            self.mapping.madvise(mmap.MADV_WILLNEED)
+
+
+    def add(self, chrom, pos):
+        for i in bitIndices(positionKey(chrom, pos), self.nbits, self.nhashes):
+            self.bits[i >> 3] |= (1 << (i & 7))
+        self.nitems = self.nitems + 1
+
+
+    """False means (chrom, pos) is definitely not in dbSNP
+    """
+    def mightContain(self, chrom, pos):
+        for i in bitIndices(positionKey(chrom, pos), self.nbits, self.nhashes):
+            if not (self.bits[i >> 3] & (1 << (i & 7))):
+                return False
+        return True
+
+
+    def save(self, path):
+        tmppath = path + '.tmp'
+        with open(tmppath, 'wb') as fh:
+            fh.write(HEADER.pack(MAGIC, self.nbits, self.nhashes,
+                self.nitems, self.fp_rate))
+            fh.write(self.bits)
+        os.replace(tmppath, path)
+
+
+    def close(self):
+        if self.fh is not None:
+            self.bits.release()
+            self.mapping.close()
+            self.fh.close()
+            self.fh = None
+
+
+"""Builds a filter over every dbSNP position of the given variant class
+   Rows are streamed with an unbuffered cursor
+"""
+def buildFromDbSnp(path, varclass='SNV', fp_rate=FP_RATE):
+    import pymysql.cursors
+    import utils as u
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from dbSNP where INFO="' + varclass + '";')
+    nitems = cursor.fetchone()[0]
+    conn.close()
+
+    bloom = BloomFilter.create(nitems, fp_rate)
+    conn = u.db_connect(cursorclass=pymysql.cursors.SSCursor)
+    cursor = conn.cursor()
+    cursor.execute('select CHR, POS from dbSNP where INFO="' + varclass + '";')
+    for row in cursor:
+        bloom.add(row[0], row[1])
+    cursor.close()
+    conn.close()
+
+    bloom.save(path)
+    return bloom
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        fp_rate = float(sys.argv[2]) if len(sys.argv) > 2 else FP_RATE
+        bloom = buildFromDbSnp(sys.argv[1], fp_rate=fp_rate)
+        print(f"{bloom.nitems} positions, {bloom.nbits} bits, " + \
+            f"{bloom.nhashes} hashes")
+    else:
+        print("An output file must be provided to build the dbSNP filter.")
+
+### EOF
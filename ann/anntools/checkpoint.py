@@ -0,0 +1,198 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Step checkpoints for resumable annotation runs
+#
+# After every completed step (sort, stage, shard) the driver records the
+# step and the files needed to continue from it in <infile>.checkpoint.json.
+# With a store, the checkpoint and those files are also mirrored outside
+# the job's working directory, which is removed when the job ends: to S3 so
+# a job redelivered to another instance can resume there, or to a local
+# directory so it can resume on the same instance.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import shutil
+
+import file_utils as fu
+
+
+class Checkpoint(object):
+
+    def __init__(self, infile, store=None):
+        self.infile = infile
+        self.path = infile + '.checkpoint.json'
+        self.store = store
+        self.state = {'steps': [], 'files': [], 'stamps': {}, 'values': {}}
+        if fu.isExist(self.path):
+            fh = open(self.path)
+            self.state = json.load(fh)
+            fh.close()
+
+
+    """Fetches the checkpoint and its files from the store when they are
+       not on local disk (e.g. the job moved to another instance)
+    """
+    def restore(self):
+        if (self.store is None) or fu.isExist(self.path):
+            return False
+        if not self.store.get(os.path.basename(self.path), self.path):
+            return False
+        fh = open(self.path)
+        self.state = json.load(fh)
+        fh.close()
+        for path in self.state['files']:
+            if not fu.isExist(path):
+                self.store.get(os.path.basename(path), path)
+        print(f"Resuming after {', '.join(self.state['steps'])}")
+        return True
+
+
+    def done(self, step):
+        if step not in self.state['steps']:
+            return False
+        # A step only counts if the files needed after it are still there
+        return all([fu.isExist(path) for path in self.state['files']])
+
+
+    """Cuts an append-only file (e.g. the count log) back to its size at
+       the last mark, dropping output of a step that did not complete
+    """
+    def truncate(self, path):
+        stamp = self.state.get('stamps', {}).get(path)
+        if (stamp is not None) and fu.isExist(path) and \
+            (os.path.getsize(path) > stamp[1]):
+            fh = open(path, 'r+')
+            fh.truncate(stamp[1])
+            fh.close()
+
+
+    def value(self, name, default=None):
+        return self.state['values'].get(name, default)
+
+
+    """Records step as completed; files are everything needed to continue
+       from here (replacing the files recorded for earlier steps)
+    """
+    def mark(self, step, files, **values):
+        previous = self.state.get('stamps', {})
+        stamps = {}
+        for path in files:
+            st = os.stat(path)
+            stamps[path] = [st.st_mtime, st.st_size]
+        self.state['steps'].append(step)
+        self.state['files'] = list(files)
+        self.state['stamps'] = stamps
+        self.state['values'].update(values)
+
+        tmppath = self.path + '.tmp'
+        fh = open(tmppath, 'w')
+        json.dump(self.state, fh)
+        fh.close()
+        os.replace(tmppath, self.path)
+
+        if self.store is not None:
+            # Only new or changed files are uploaded (e.g. .order only once)
+            for path in files:
+                if previous.get(path) != stamps[path]:
+                    self.store.put(path, os.path.basename(path))
+            for path in previous:
+                if path not in stamps:
+                    self.store.delete(os.path.basename(path))
+            self.store.put(self.path, os.path.basename(self.path))
+
+
+    def clear(self):
+        fu.delete(self.path)
+        if self.store is not None:
+            self.store.clear()
+        self.state = {'steps': [], 'files': [], 'stamps': {}, 'values': {}}
+
+
+"""Checkpoint store in S3: objects under bucket/prefix/
+   transfer_config (a boto3 TransferConfig) tunes multipart transfers
+"""
+class S3Store(object):
+
+    def __init__(self, s3, bucket, prefix, transfer_config=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/')
+        self.transfer_config = transfer_config
+
+
+    def put(self, path, name):
+        # A failed upload only costs the ability to resume elsewhere
+        try:
+            self.s3.upload_file(path, self.bucket, self.prefix + '/' + name,
+                Config=self.transfer_config)
+        except Exception as e:
+            print(f"Could not upload checkpoint object {name}: {e}")
+
+
+    def get(self, name, path):
+        try:
+            self.s3.download_file(self.bucket, self.prefix + '/' + name, path,
+                Config=self.transfer_config)
+            return True
+        except Exception as e:
+            print(f"No checkpoint object {name}: {e}")
+            return False
+
+
+    def delete(self, name):
+        try:
+            self.s3.delete_object(Bucket=self.bucket,
+                Key=self.prefix + '/' + name)
+        except Exception as e:
+            print(f"Could not delete checkpoint object {name}: {e}")
+
+
+    def clear(self):
+        try:
+            response = self.s3.list_objects_v2(Bucket=self.bucket,
+                Prefix=self.prefix + '/')
+            for obj in response.get('Contents', []):
+                self.s3.delete_object(Bucket=self.bucket, Key=obj['Key'])
+        except Exception as e:
+            print(f"Could not clear checkpoint {self.prefix}: {e}")
+
+
+"""Checkpoint store on local disk: files under directory/
+"""
+class LocalStore(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+
+    def put(self, path, name):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            shutil.copyfile(path, os.path.join(self.directory, name))
+        except Exception as e:
+            print(f"Could not store checkpoint file {name}: {e}")
+
+
+    def get(self, name, path):
+        try:
+            shutil.copyfile(os.path.join(self.directory, name), path)
+            return True
+        except Exception as e:
+            print(f"No checkpoint file {name}: {e}")
+            return False
+
+
+    def delete(self, name):
+        fu.delete(os.path.join(self.directory, name))
+
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+### EOF
@@ -0,0 +1,97 @@
+# compare_baseline.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Checks that the default (point query) pipeline still annotates exactly
+# like an earlier revision of anntools
+#
+# The anntools of the given git revision (by default the first commit) are
+# exported to a temporary directory; both versions then annotate a copy of
+# every data/*.vcf and their .annot.vcf and .count.log files are compared,
+# ignoring the provenance headers the old version does not write. Needs the
+# reference database, like any annotation run. Exits 1 on any difference.
+#
+#   python compare_baseline.py [revision] [file.vcf ...]
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import glob
+import shutil
+import difflib
+import tempfile
+import subprocess
+
+import driver
+
+ANNTOOLS = os.path.dirname(os.path.abspath(__file__))
+RUN = 'import sys, driver; driver.run(sys.argv[1], "vcf")'
+
+
+"""Exports ann/anntools of revision into directory; returns its path
+"""
+def exportRevision(revision, directory):
+    top = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'],
+        cwd=ANNTOOLS).decode().strip()
+    archive = subprocess.Popen(['git', 'archive', revision, 'ann/anntools'],
+        cwd=top, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', directory], stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise RuntimeError(f"git archive {revision} failed")
+    return os.path.join(directory, 'ann', 'anntools')
+
+
+"""Annotates a copy of vcf with the anntools in code; returns the outputs
+   as {name: lines}
+"""
+def annotate(code, vcf, directory):
+    os.makedirs(directory, exist_ok=True)
+    infile = os.path.join(directory, os.path.basename(vcf))
+    shutil.copyfile(vcf, infile)
+    subprocess.check_call([sys.executable, '-c', RUN, infile], cwd=code)
+    outputs = {}
+    finalout = (infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    for name, path in [('annot', finalout), ('log', infile + '.count.log')]:
+        fh = open(path)
+        outputs[name] = [line for line in fh.read().splitlines()
+            if not line.startswith(driver.PROVENANCE_PREFIX)]
+        fh.close()
+    return outputs
+
+
+def compare(revision, vcfs):
+    different = 0
+    workdir = tempfile.mkdtemp(prefix='anntools_compare_')
+    try:
+        baseline = exportRevision(revision, workdir)
+        for vcf in vcfs:
+            name = os.path.basename(vcf)
+            old = annotate(baseline, vcf, os.path.join(workdir, 'old'))
+            new = annotate(ANNTOOLS, vcf, os.path.join(workdir, 'new'))
+            for output in ['annot', 'log']:
+                if old[output] == new[output]:
+                    continue
+                different = different + 1
+                print(f"{name}: {output} differs from {revision}")
+                diff = difflib.unified_diff(old[output], new[output],
+                    revision, 'working tree', lineterm='', n=0)
+                for line in list(diff)[:40]:
+                    print('  ' + line)
+            print(f"{name} - compared.")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return different
+
+
+if __name__ == '__main__':
+    revision = sys.argv[1] if len(sys.argv) > 1 else \
+        subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD'],
+            cwd=ANNTOOLS).decode().split()[0]
+    vcfs = sys.argv[2:] or sorted([vcf for vcf in
+        glob.glob(os.path.join(ANNTOOLS, 'data', '*.vcf'))
+        if not vcf.endswith('.annot.vcf')])
+    sys.exit(1 if compare(revision, vcfs) > 0 else 0)
+
+### EOF
@@ -12,110 +12,616 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import multiprocessing
+import shutil
+import hashlib
 import file_utils as fu
 import annotate as ann
+import utils as u
+import vcf_sort as vs
+import bloom as bf
+import shard as sh
+import index as ix
 
-def run(infile, format):
+TFBS_TABLES = ['tfbsConsSites' + c for c in ['1','2','3','4','5','6','7','8',
+    '9','10','11','12','13','14','15','16','17','18','19','20','21','22',
+    'X','Y']]
 
-    print("Running . . .")
+"""Annotation stages, in pipeline order
+   fn/args: annotate function and its table arguments
+   tables: reference tables the stage reads (for provenance)
+   keys: INFO keys the stage adds (stripped on incremental re-annotation)
+   group: stages whose INFO keys overlap are always re-run together
+   sweep: stage can use sweep-line region joins
+"""
+STAGES = [
+    {'name': 'dbSNP', 'fn': ann.getSnpsFromDbSnp, 'args': {},
+        'tables': ['dbSNP'], 'keys': ['DB', 'VC', 'GMAF'],
+        'group': 'dbSNP', 'sweep': False, 'filter': True},
+    {'name': 'BigRefGene', 'fn': ann.getBigRefGene, 'args': {},
+        'tables': ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+            'chrom_pos_unequal'],
+        'keys': ['name', 'name2', 'transcriptStrand', 'positionType',
+            'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+            'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+            'changesAA', 'functionalClass', 'codingCoordStr',
+            'proteinCoordStr', 'inCodingRegion', 'spliceInfo', 'uorfChange'],
+        'group': 'genes', 'sweep': False},
+    {'name': 'refGene', 'fn': ann.getGenes,
+        'args': {'table': 'refGene', 'promoter_offset': 500},
+        'tables': ['refGene', 'cpgIslandExt'],
+        'keys': ['name', 'name2', 'transcriptStrand', 'positionType',
+            'exon', 'non_coding_exon', 'putativePromoterRegion'],
+        'group': 'genes', 'sweep': True},
+    {'name': 'cytoBand', 'fn': ann.addOverlapWithCytoband,
+        'args': {'table': 'cytoBand'},
+        'tables': ['cytoBand'], 'keys': ['cytoBand'],
+        'group': 'cytoBand', 'sweep': True},
+    {'name': 'gadAll', 'fn': ann.addOverlapWithGadAll,
+        'args': {'table': 'gadAll'},
+        'tables': ['gadAll'], 'keys': ['gadAll'],
+        'group': 'gadAll', 'sweep': True},
+    {'name': 'gwasCatalog', 'fn': ann.addOverlapWithGwasCatalog,
+        'args': {'table': 'gwasCatalog'},
+        'tables': ['gwasCatalog'], 'keys': ['gwasCatalog'],
+        'group': 'gwasCatalog', 'sweep': True},
+    {'name': 'miRNA', 'fn': ann.addOverlapWithMiRNA,
+        'args': {'table': 'targetScanS'},
+        'tables': ['targetScanS'], 'keys': ['miRNAsites'],
+        'group': 'miRNA', 'sweep': True},
+    {'name': 'HUGO Gene Nomenclature Committee',
+        'fn': ann.addOverlapWitHUGOGeneNomenclature,
+        'args': {'table': 'hugo'},
+        'tables': ['hugo'], 'keys': ['HGNC_GeneAnnotation'],
+        'group': 'hugo', 'sweep': True},
+    {'name': 'dgv_Cnv', 'fn': ann.addOverlapWithCnvDatabase,
+        'args': {'table': 'dgv_Cnv'},
+        'tables': ['dgv_Cnv'], 'keys': ['dgv_Cnv'],
+        'group': 'dgv_Cnv', 'sweep': True},
+    {'name': 'abParts_IG_T_CelReceptors', 'fn': ann.addOverlapWithCnvDatabase,
+        'args': {'table': 'abParts_IG_T_CelReceptors'},
+        'tables': ['abParts_IG_T_CelReceptors'],
+        'keys': ['abParts_IG_T_CelReceptors'],
+        'group': 'abParts_IG_T_CelReceptors', 'sweep': True},
+    {'name': 'mcCarroll_Cnv', 'fn': ann.addOverlapWithCnvDatabase,
+        'args': {'table': 'mcCarroll_Cnv'},
+        'tables': ['mcCarroll_Cnv'], 'keys': ['mcCarroll_Cnv'],
+        'group': 'mcCarroll_Cnv', 'sweep': True},
+    {'name': 'conrad_Cnv', 'fn': ann.addOverlapWithCnvDatabase,
+        'args': {'table': 'conrad_Cnv'},
+        'tables': ['conrad_Cnv'], 'keys': ['conrad_Cnv'],
+        'group': 'conrad_Cnv', 'sweep': True},
+    {'name': 'genomicSuperDups', 'fn': ann.addOverlapWithGenomicSuperDups,
+        'args': {'table': 'genomicSuperDups'},
+        'tables': ['genomicSuperDups'],
+        'keys': ['genomicSuperDups', 'otherChrom', 'otherStart', 'otherEnd'],
+        'group': 'genomicSuperDups', 'sweep': True},
+    {'name': 'tfbsConsSites', 'fn': ann.addOverlapWithTfbsConsSites,
+        'args': {'table': 'tfbsConsSites'},
+        'tables': TFBS_TABLES, 'keys': ['tfbsRegion'],
+        'group': 'tfbsConsSites', 'sweep': True},
+]
+
+PROVENANCE_PREFIX = '##anntoolsStage=<'
+# Version of a stage whose tables' versions cannot be read; always stale
+UNKNOWN_VERSION = 'unknown'
+
+
+"""Version of every stage: a short digest of its tables' versions, or
+   UNKNOWN_VERSION if any of them cannot be read
+   table_versions overrides the database-derived version of a table
+   (case-insensitive), e.g. {'dbsnp': '150'}
+"""
+def getStageVersions(stages=STAGES, table_versions=None):
+    overrides = {}
+    for k, v in (table_versions or {}).items():
+        overrides[str(k).lower()] = str(v)
+
+    tables = []
+    for stage in stages:
+        tables.extend(stage['tables'])
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    versions = u.getTableVersions(cursor,
+        [t for t in tables if t.lower() not in overrides])
+    conn.close()
+    for t in tables:
+        if t.lower() in overrides:
+            versions[t] = overrides[t.lower()]
+
+    stage_versions = {}
+    for stage in stages:
+        if None in [versions[t] for t in stage['tables']]:
+            stage_versions[stage['name']] = UNKNOWN_VERSION
+            continue
+        v = ';'.join([t + '=' + versions[t] for t in stage['tables']])
+        stage_versions[stage['name']] = \
+            hashlib.sha1(v.encode('utf-8')).hexdigest()[:12]
+    return stage_versions
+
+
+"""Provenance header lines, one per stage
+"""
+def provenanceHeaders(stage_versions, stages=STAGES):
+    headers = []
+    for stage in stages:
+        headers.append(PROVENANCE_PREFIX + 'ID=' + stage['name'] + \
+            ',Tables=' + '|'.join(stage['tables']) + \
+            ',Version=' + stage_versions[stage['name']] + '>')
+    return headers
+
+
+"""Reads per-stage versions from the provenance headers of an annotated file
+"""
+def readProvenance(annotfile):
+    stage_versions = {}
+    fh = open(annotfile)
+    for line in fh:
+        if not line.startswith('#'):
+            break
+        if line.startswith(PROVENANCE_PREFIX):
+            meta = line.strip()[len(PROVENANCE_PREFIX):-1]
+            fields = dict([f.split('=', 1) for f in meta.split(',')])
+            stage_versions[fields['ID']] = fields['Version']
+    fh.close()
+    return stage_versions
+
+
+"""Final write: copies infile to outfile with fresh provenance headers
+   (old ones dropped), placed just before the #CHROM line. With indexfile,
+   also writes the positional index of outfile there (see index.py).
+   Returns the number of records
+"""
+def writeAnnotated(infile, outfile, headers, indexfile=None):
+    fh = open(infile)
+    fh_out = open(outfile, 'w')
+    index = ix.IndexWriter() if indexfile is not None else None
+    offset = 0
+    pending = True
+    nrecords = 0
+    for line in fh:
+        if line.startswith(PROVENANCE_PREFIX):
+            continue
+        if not line.startswith('#') and len(line.strip()) > 0:
+            nrecords = nrecords + 1
+        if pending and (line.startswith('#CHROM') or not line.startswith('##')):
+            for h in headers:
+                fh_out.write(h + '\n')
+                offset = offset + len((h + '\n').encode(fh_out.encoding))
+            pending = False
+        fh_out.write(line)
+        if index is not None:
+            nbytes = len(line.encode(fh_out.encoding))
+            index.add(line, offset, nbytes)
+            offset = offset + nbytes
+    if pending:
+        for h in headers:
+            fh_out.write(h + '\n')
+            offset = offset + len((h + '\n').encode(fh_out.encoding))
+    fh.close()
+    fh_out.close()
+    if index is not None:
+        index.size = offset
+        index.write(indexfile)
+    return nrecords
+
+
+"""Removes what the given stages added from every record of infile
+   original is the input infile was annotated from: its INFO items and ID
+   are always kept, so keys the input carried itself (e.g. a caller's DB
+   flag) survive. Other items with a stage key are dropped, together with
+   the keyless items that continue them (cytoBand joins several bands with
+   ';'). Records of the two files must correspond one to one.
+"""
+def stripStages(infile, outfile, stages, original, sep='\t'):
+    keys = set()
+    for stage in stages:
+        keys.update(stage['keys'])
+    stripId = 'dbSNP' in [stage['name'] for stage in stages]
+
+    fh = open(infile)
+    fh_orig = open(original)
+    fh_out = open(outfile, 'w')
+    for line in fh:
+        line = line.rstrip('\r\n')
+        if line.startswith('#') or len(line.strip()) == 0:
+            fh_out.write(line + '\n')
+            continue
+        orig = nextRecord(fh_orig)
+        # Some stages pad fields with a space; compare them stripped
+        fields = [f.strip() for f in line.split(sep)]
+        if (orig is None) or (orig[0].strip() != fields[0]) or \
+            (orig[1].strip() != fields[1]):
+            raise ValueError(f"{infile} does not match {original} at " + \
+                f"{fields[0]}:{fields[1]}")
+
+        kept = {}
+        for item in orig[7].strip().split(';'):
+            kept[item] = kept.get(item, 0) + 1
+        info = []
+        stripping = False
+        for item in fields[7].split(';'):
+            if kept.get(item, 0) > 0:
+                kept[item] = kept[item] - 1
+                info.append(item)
+                stripping = False
+            elif item.split('=', 1)[0] in keys:
+                stripping = True
+            elif stripping and ('=' not in item):
+                continue
+            else:
+                info.append(item)
+                stripping = False
+        info = [f for f in info if len(f) > 0 and f != '.']
+        if len(info) == 0:
+            info = ['.']
+        fields[7] = ';'.join(info)
+        if stripId:
+            fields[2] = orig[2].strip()
+        fh_out.write(sep.join(fields) + '\n')
+    fh.close()
+    fh_orig.close()
+    fh_out.close()
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+
+"""Fields of the next record of fh, or None at the end
+"""
+def nextRecord(fh, sep='\t'):
+    for line in fh:
+        line = line.rstrip('\r\n')
+        if line.startswith('#') or len(line.strip()) == 0:
+            continue
+        return line.split(sep)
+    return None
+
+
+"""Runs stages in order on infile + firstin
+   Stage i writes infile + '.i' and the output of stage i-1 is removed once
+   stage i is recorded, so at most two stage outputs exist at a time;
+   returns the extension of the last output
+"""
+def runStages(infile, format, stages, firstin='', sweep=False, bloom=None,
+    checkpoint=None, keep=[]):
+    tmpextin = firstin
+    logfile = infile + '.count.log'
+    for i, stage in enumerate(stages, 1):
+        tmpextout = '.' + str(i)
+        if (checkpoint is not None) and checkpoint.done(stage['name']):
+            print(f"{stage['name']} - already done.")
+            tmpextin = tmpextout
+            continue
+        if checkpoint is not None:
+            checkpoint.truncate(logfile)
+        kwargs = dict(stage['args'])
+        if stage['sweep']:
+            kwargs['sweep'] = sweep
+        if stage.get('filter') and (bloom is not None):
+            kwargs['bloom'] = bloom
+        stage['fn'](vcf=infile, format=format, tmpextin=tmpextin,
+            tmpextout=tmpextout, **kwargs)
+        print(f"{stage['name']} - done.")
+        if checkpoint is not None:
+            checkpoint.mark(stage['name'],
+                keep + existing([infile + tmpextout, logfile]))
+        # Only the latest output is needed from here on (firstin is the
+        # input or the sorted input, which the caller owns)
+        if tmpextin != firstin:
+            fu.delete(infile + tmpextin)
+        tmpextin = tmpextout
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+    return tmpextin
+
+
+"""Runs the annotation pipeline on infile
+   With sort_input the records are first sorted by (chrom, pos) using a
+   memory-bounded external sort (at most sort_max_records held in memory);
+   the annotated output is put back in input order at the end. Sorted
+   inputs of at least sweep_min_records records are annotated against the
+   region tables with a sweep-line merge-join instead of one query per
+   record. The output carries one provenance header per stage.
+   dbsnp_filter is the path of a dbSNP Bloom filter (see bloom.py); when
+   given, positions it rules out are not looked up in dbSNP.
+   sweep forces the region join method for an input that is already
+   sorted (e.g. a shard of a sorted file). With a checkpoint.Checkpoint,
+   every completed step is recorded and steps completed by an earlier,
+   interrupted run are skipped. Returns the number of records.
+"""
+def run(infile, format, sort_input=False, sort_max_records=vs.MAX_RECORDS,
+    sweep_min_records=10000, table_versions=None, stages=STAGES,
+    stage_versions=None, dbsnp_filter=None, sweep=None, checkpoint=None):
+
+    print("Running . . .")
+
+    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+    if (checkpoint is not None) and checkpoint.done('annotated'):
+        print("Annotation - already done.")
+        return checkpoint.value('nrecords')
+
+    if stage_versions is None:
+        stage_versions = getStageVersions(table_versions=table_versions)
+
+    bloom = None
+    if (dbsnp_filter is not None) and \
+        any([stage.get('filter') for stage in stages]):
+        try:
+            bloom = bf.BloomFilter.load(dbsnp_filter)
+        except Exception as e:
+            print(f"dbSNP filter unavailable, querying every record: {e}")
+
+    firstin = ''
+    keep = []
+    if sweep is None:
+        sweep = False
+    if sort_input:
+        nrecords = sortInput(infile, sort_max_records, checkpoint)
+        firstin = '.sorted'
+        keep = [infile + '.order']
+        sweep = (nrecords >= sweep_min_records)
+
+    try:
+        lastout = runStages(infile, format, stages, firstin=firstin,
+            sweep=sweep, bloom=bloom, checkpoint=checkpoint, keep=keep)
+    finally:
+        if bloom is not None:
+            bloom.close()
+
+    if sort_input:
+        vs.restoreOrder(infile + lastout, infile + '.restored',
+            infile + '.order', max_records=sort_max_records)
+        fu.delete(infile + lastout)
+        fu.delete(infile + '.sorted')
+        fu.delete(infile + '.order')
+        lastout = '.restored'
+
+    nrecords = writeAnnotated(infile + lastout, finalout,
+        provenanceHeaders(stage_versions), indexfile=finalout + '.idx')
+    fu.delete(infile + lastout)
+    markAnnotated(checkpoint, infile, finalout, nrecords)
+    return nrecords
+
+
+"""Sorts infile to infile.sorted (order in infile.order) unless an earlier
+   run already did; returns the number of records
+"""
+def sortInput(infile, sort_max_records, checkpoint=None):
+    if (checkpoint is not None) and checkpoint.done('sort'):
+        print("Sort - already done.")
+        return checkpoint.value('sorted_records')
+    nrecords = vs.sortVcf(infile, infile + '.sorted', infile + '.order',
+        max_records=sort_max_records)
+    if checkpoint is not None:
+        checkpoint.mark('sort', [infile + '.sorted', infile + '.order'],
+            sorted_records=nrecords)
+    print("Sort - done.")
+    return nrecords
+
+
+def markAnnotated(checkpoint, infile, finalout, nrecords):
+    if checkpoint is not None:
+        checkpoint.mark('annotated',
+            existing([finalout, finalout + '.idx', infile + '.count.log']),
+            nrecords=nrecords)
+
+
+def existing(paths):
+    return [path for path in paths if fu.isExist(path)]
+
+
+"""Runs the annotation pipeline on shards of infile in parallel
+   The input is split into nshards contiguous shards, each annotated by
+   run in its own process; the annotated shards and their count logs are
+   then merged into the same outputs run would produce. With sort_input
+   the whole input is sorted first, so every shard covers a contiguous
+   range of positions, and the merged output is put back in input order.
+   With a checkpoint, each completed shard is recorded, so a resumed run
+   only annotates the shards that were not finished. Returns the number
+   of records.
+"""
+def runSharded(infile, format, nshards, sort_input=False,
+    sort_max_records=vs.MAX_RECORDS, sweep_min_records=10000,
+    table_versions=None, dbsnp_filter=None, checkpoint=None):
+
+    print(f"Running in {str(nshards)} shards . . .")
+
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    if (checkpoint is not None) and checkpoint.done('annotated'):
+        print("Annotation - already done.")
+        return checkpoint.value('nrecords')
+
+    stage_versions = getStageVersions(table_versions=table_versions)
+
+    src = infile
+    keep = []
+    if sort_input:
+        sortInput(infile, sort_max_records, checkpoint)
+        src = infile + '.sorted'
+        keep = [infile + '.order']
+
+    if (checkpoint is not None) and checkpoint.done('split'):
+        shards = checkpoint.value('shards')
+    else:
+        shards = sh.splitVcf(src, nshards)
+        if checkpoint is not None:
+            checkpoint.mark('split', keep + [path for (path, count) in shards],
+                shards=shards)
+    annotfiles = [(path + '.annot').replace('.vcf.annot', '.annot.vcf')
+        for (path, count) in shards]
+
+    # Files needed to resume once the shards in finished are complete
+    def shardFiles(finished):
+        files = list(keep)
+        for k, (path, count) in enumerate(shards):
+            if k in finished:
+                files.extend([annotfiles[k], path + '.count.log'])
+            else:
+                files.append(path)
+        return files
+
+    finished = set([k for k in range(len(shards)) if (checkpoint is not None)
+        and checkpoint.done('shard' + str(k))])
+    pending = [k for k in range(len(shards)) if k not in finished]
+    for k in pending:
+        # Left over from an interrupted attempt at this shard
+        fu.delete(shards[k][0] + '.count.log')
+
+    failure = None
+    pool = multiprocessing.Pool(processes=max(1, len(pending)))
+    completed = False
+    try:
+        results = [(k, pool.apply_async(run, (shards[k][0], format), {
+            'sort_max_records': sort_max_records,
+            'stage_versions': stage_versions,
+            'dbsnp_filter': dbsnp_filter,
+            'sweep': sort_input and (shards[k][1] >= sweep_min_records)}))
+            for k in pending]
+        for (k, result) in results:
+            try:
+                result.get()
+            except Exception as e:
+                failure = failure or e
+                continue
+            finished.add(k)
+            if checkpoint is not None:
+                checkpoint.mark('shard' + str(k), shardFiles(finished))
+        completed = True
+    finally:
+        # Interrupted (scratch quota, SIGTERM): stop the shards now rather
+        # than wait for them to finish
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+    if failure is not None:
+        raise failure
+    print("Shards - done.")
+
+    sh.concatVcf(annotfiles, infile + '.merged')
+    sh.mergeCountLogs([path + '.count.log' for (path, count) in shards],
+        infile + '.count.log')
+    for (path, count) in shards:
+        fu.delete(path)
+        fu.delete(path + '.count.log')
+    for annotfile in annotfiles:
+        fu.delete(annotfile)
+
+    lastout = '.merged'
+    if sort_input:
+        vs.restoreOrder(infile + lastout, infile + '.restored',
+            infile + '.order', max_records=sort_max_records)
+        fu.delete(infile + lastout)
+        fu.delete(infile + '.sorted')
+        fu.delete(infile + '.order')
+        lastout = '.restored'
+
+    nrecords = writeAnnotated(infile + lastout, finalout,
+        provenanceHeaders(stage_versions), indexfile=finalout + '.idx')
+    fu.delete(infile + lastout)
+    markAnnotated(checkpoint, infile, finalout, nrecords)
+    return nrecords
+
+
+"""Incremental re-annotation of a previously annotated file
+   Only stages whose reference tables changed since annotfile was produced
+   (per its provenance headers) are re-run: what they added is stripped
+   and the stages run again; everything else is reused as is. Stages in a
+   changed group are re-run together. infile is the input annotfile was
+   annotated from (it is left as it was); the new output is named the same
+   way run does (infile.vcf -> infile.annot.vcf) and logfile, if given,
+   supplies the .count.log entries of the stages that are not re-run.
+   Returns the names of the re-run stages.
+"""
+def reannotate(annotfile, infile, format, table_versions=None,
+    logfile=None, sort_input=False, sort_max_records=vs.MAX_RECORDS,
+    sweep_min_records=10000, dbsnp_filter=None):
+
+    stored = readProvenance(annotfile)
+    current = getStageVersions(table_versions=table_versions)
+
+    groups = set([stage['group'] for stage in STAGES
+        if (stored.get(stage['name']) != current[stage['name']]) or
+        (current[stage['name']] == UNKNOWN_VERSION)])
+    changed = [stage for stage in STAGES if stage['group'] in groups]
+    print("Changed stages: " + \
+        (', '.join([stage['name'] for stage in changed]) or 'none'))
+
+    if len(changed) == 0:
+        if (logfile is not None) and fu.isExist(logfile):
+            shutil.copyfile(logfile, infile + '.count.log')
+        finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
+        writeAnnotated(annotfile, finalout, provenanceHeaders(current),
+            indexfile=finalout + '.idx')
+        return []
+
+    if not fu.isExist(infile):
+        raise ValueError(f"{infile}: the original input is needed to " + \
+            "tell its own INFO and ID from the annotations")
+
+    # The re-run stages write a log of their own, merged with the old one
+    # below (the dbSNP stage would truncate a seeded log anyway)
+    fu.delete(infile + '.count.log')
+    # The stripped records take the input's name while the stages run
+    original = infile + '.input'
+    os.replace(infile, original)
+    try:
+        stripStages(annotfile, infile, changed, original)
+        run(infile, format, sort_input=sort_input,
+            sort_max_records=sort_max_records,
+            sweep_min_records=sweep_min_records, stages=changed,
+            stage_versions=current, dbsnp_filter=dbsnp_filter)
+    finally:
+        os.replace(original, infile)
+    if (logfile is not None) and fu.isExist(logfile):
+        mergeStageLogs(logfile, infile + '.count.log',
+            [stage['name'] for stage in changed])
+    return [stage['name'] for stage in changed]
+
+
+"""Splits count log lines into {stage name: lines}
+   Lines that belong to no known stage are kept under None
+"""
+def countLogSections(lines, stages=STAGES):
+    labels = {}
+    for stage in stages:
+        for label in stage['keys'] + [stage['args'].get('table')]:
+            labels.setdefault(label, stage['name'])
+    sections = {}
+    current = None
+    for line in lines:
+        if line.startswith(('## Please notice', '## Numbers may exceed',
+            'Total: ', 'In dbSNP: ', '## dbSNP filter: ')):
+            current = 'dbSNP'
+        elif line.startswith('Variants located:'):
+            current = 'refGene'
+        elif line.startswith('In ') and ': ' in line:
+            current = labels.get(line[3:line.index(': ')])
+        elif current != 'refGene':
+            # Only the refGene stage writes lines without a label of their own
+            current = None
+        sections.setdefault(current, []).append(line)
+    return sections
+
+
+"""Replaces the entries of the re-run stages in oldlog by those in newlog,
+   writing the result to newlog in stage order
+"""
+def mergeStageLogs(oldlog, newlog, rerun, stages=STAGES):
+    fh = open(oldlog)
+    old = countLogSections(fh.read().splitlines(), stages)
+    fh.close()
+    fh = open(newlog)
+    new = countLogSections(fh.read().splitlines(), stages)
+    fh.close()
+
+    fh_out = open(newlog, 'w')
+    for name in [stage['name'] for stage in stages] + [None]:
+        source = new if name in rerun else old
+        for line in source.get(name, []):
+            fh_out.write(line + '\n')
+    fh_out.close()
 
-### EOF
\ No newline at end of file
+### EOF
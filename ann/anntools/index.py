@@ -0,0 +1,87 @@
+# index.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sidecar positional index for annotated VCF files
+#
+# For every chromosome and bin of BIN_SIZE positions the index lists the
+# byte ranges of the file holding that bin's records, so a reader can fetch
+# a region with ranged reads instead of the whole file. Runs of consecutive
+# records in the same bin share one range, so a sorted file has one line
+# per bin; output in input order just has more ranges. Format (text):
+#
+#   ##gas-index=1
+#   ##bin_size=16384
+#   ##header_bytes=<offset of the first record>
+#   ##size=<size of the indexed file>
+#   <chrom>\t<bin>\t<start>\t<end>\t<records>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+
+VERSION = 1
+BIN_SIZE = 16384
+
+
+class IndexWriter(object):
+
+    def __init__(self, bin_size=BIN_SIZE):
+        self.bin_size = bin_size
+        self.ranges = []
+        self.header_bytes = None
+        self.size = 0
+
+
+    """Records a line written at byte offset start with length nbytes
+    """
+    def add(self, line, start, nbytes):
+        self.size = start + nbytes
+        if line.startswith('#') or len(line.strip()) == 0:
+            return
+        if self.header_bytes is None:
+            self.header_bytes = start
+        fields = line.split('\t', 2)
+        try:
+            bin = int(fields[1]) // self.bin_size
+        except (IndexError, ValueError):
+            return
+        last = self.ranges[-1] if self.ranges else None
+        if (last is not None) and (last[0] == fields[0]) and \
+            (last[1] == bin) and (last[3] == start):
+            last[3] = start + nbytes
+            last[4] = last[4] + 1
+        else:
+            self.ranges.append([fields[0], bin, start, start + nbytes, 1])
+
+
+    def write(self, path):
+        tmppath = path + '.tmp'
+        fh = open(tmppath, 'w')
+        fh.write('##gas-index=' + str(VERSION) + '\n')
+        fh.write('##bin_size=' + str(self.bin_size) + '\n')
+        header_bytes = self.size if self.header_bytes is None else self.header_bytes
+        fh.write('##header_bytes=' + str(header_bytes) + '\n')
+        fh.write('##size=' + str(self.size) + '\n')
+        for r in self.ranges:
+            fh.write('\t'.join([str(x) for x in r]) + '\n')
+        fh.close()
+        os.replace(tmppath, path)
+
+
+"""Builds the index of an existing file (e.g. one annotated before indexes
+   were written)
+"""
+def indexFile(path, indexfile, bin_size=BIN_SIZE):
+    writer = IndexWriter(bin_size)
+    offset = 0
+    fh = open(path, 'rb')
+    for line in fh:
+        writer.add(line.decode('utf-8', errors='replace'), offset, len(line))
+        offset = offset + len(line)
+    fh.close()
+    writer.write(indexfile)
+
+### EOF
@@ -30,7 +30,12 @@ class Timer(object):
 
 if __name__ == '__main__':
 	# Call the AnnTools pipeline
-	if len(sys.argv) > 1:
+	# An optional second argument names a previous .annot.vcf of the same
+	# input; only the stages whose reference tables changed are re-run
+	if len(sys.argv) > 2:
+		with Timer():
+			driver.reannotate(sys.argv[2], sys.argv[1], 'vcf')
+	elif len(sys.argv) > 1:
 		with Timer():
 			driver.run(sys.argv[1], 'vcf')
 	else:
@@ -0,0 +1,151 @@
+# shard.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Splitting a VCF file into shards for parallel annotation, and merging the
+# annotated shards and their count logs back together
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+
+import file_utils as fu
+
+# Count log lines written by annotate.py
+TOTAL = re.compile(r'^Total: (?P<n1>\d+)$')
+IN_DBSNP = re.compile(r'^In dbSNP: (?P<n1>\d+) \(.*%\)$')
+DBSNP_FILTER = re.compile(r'^## dbSNP filter: (?P<n1>\d+) queries skipped, '
+    r'(?P<n2>\d+) sent, (?P<n3>\d+) false positives \(.*\)$')
+IN_TABLE = re.compile(r'^(?P<label>In .+): (?P<n1>\d+) in (?P<n2>\d+) variants$')
+IN_REGION = re.compile(r'^(?P<label>In .+) (?P<n1>\d+)$')
+
+
+"""Splits infile into at most nshards files of contiguous records
+   Every shard gets all header lines. Shard k is written to
+   infile + '.shard<k>.vcf'. Returns a list of (path, number of records);
+   shards that would be empty are not written.
+"""
+def splitVcf(infile, nshards):
+    headers = []
+    nrecords = 0
+    fh = open(infile)
+    for line in fh:
+        if line.startswith('#'):
+            headers.append(line)
+        elif len(line.strip()) > 0:
+            nrecords = nrecords + 1
+    fh.close()
+
+    per_shard = max(1, -(-nrecords // max(1, nshards)))
+    shards = []
+    fh_out = None
+    fh = open(infile)
+    for line in fh:
+        if line.startswith('#') or len(line.strip()) == 0:
+            continue
+        if (fh_out is None) or (shards[-1][1] == per_shard):
+            if fh_out is not None:
+                fh_out.close()
+            path = infile + '.shard' + str(len(shards)) + '.vcf'
+            fh_out = open(path, 'w')
+            fh_out.writelines(headers)
+            shards.append([path, 0])
+        fh_out.write(line)
+        shards[-1][1] = shards[-1][1] + 1
+    fh.close()
+    if fh_out is not None:
+        fh_out.close()
+
+    return [(path, count) for (path, count) in shards]
+
+
+"""Concatenates annotated shards: headers of the first, then all records
+   Returns the number of records
+"""
+def concatVcf(infiles, outfile):
+    nrecords = 0
+    fh_out = open(outfile, 'w')
+    for i, infile in enumerate(infiles):
+        fh = open(infile)
+        for line in fh:
+            if line.startswith('#'):
+                if i == 0:
+                    fh_out.write(line)
+            elif len(line.strip()) > 0:
+                fh_out.write(line)
+                nrecords = nrecords + 1
+        fh.close()
+    fh_out.close()
+    return nrecords
+
+
+"""Merges the count logs of the shards of one input
+   All shards run the same stages, so their logs have the same lines with
+   different numbers. Only the counts of the known line formats (see
+   annotate.py) are summed line by line, never digits in a label, and the
+   percentages that depend on them are recomputed; any other line is kept
+   as the first shard wrote it.
+"""
+def mergeCountLogs(logfiles, outfile):
+    logs = []
+    for logfile in logfiles:
+        if fu.isExist(logfile):
+            fh = open(logfile)
+            logs.append(fh.read().splitlines())
+            fh.close()
+
+    fh_out = open(outfile, 'w')
+    if (len(logs) == 0) or (len(set([len(log) for log in logs])) > 1):
+        # Not the same shape; keep every shard's log as is
+        for log in logs:
+            for line in log:
+                fh_out.write(line + '\n')
+        fh_out.close()
+        return
+
+    total = 0
+    for lines in zip(*logs):
+        line = lines[0]
+        counts = sumCounts(TOTAL, lines)
+        if counts is not None:
+            # Each shard's dbSNP stage counts one more than its records
+            total = counts[1][0] - (len(logs) - 1)
+            line = f"Total: {str(total)}"
+        elif sumCounts(IN_DBSNP, lines) is not None:
+            var_count = sumCounts(IN_DBSNP, lines)[1][0]
+            ratioInDbSnp = (var_count / float(max(1, total))) * 100
+            line = f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)"
+        elif sumCounts(DBSNP_FILTER, lines) is not None:
+            skipped, queried, false_positives = sumCounts(DBSNP_FILTER, lines)[1]
+            fpRate = (false_positives / float(max(1, false_positives + skipped))) * 100
+            line = f"## dbSNP filter: {str(skipped)} queries skipped, " + \
+                f"{str(queried)} sent, {str(false_positives)} false positives " + \
+                f"({str(round(fpRate, 2))}% of non-dbSNP positions)"
+        elif sumCounts(IN_TABLE, lines) is not None:
+            label, (var_count, line_count) = sumCounts(IN_TABLE, lines)
+            line = f"{label}: {str(var_count)} in {str(line_count)} variants"
+        elif sumCounts(IN_REGION, lines) is not None:
+            label, (count,) = sumCounts(IN_REGION, lines)
+            line = f"{label} {str(count)}"
+        fh_out.write(line + '\n')
+    fh_out.close()
+
+
+"""Matches pattern against the same line of every shard's log
+   Returns (label, [sum of each count group]), or None unless every line
+   matches with the same label
+"""
+def sumCounts(pattern, lines):
+    matches = [pattern.match(line) for line in lines]
+    if None in matches:
+        return None
+    labels = set([m.groupdict().get('label') for m in matches])
+    if len(labels) > 1:
+        return None
+    names = sorted([name for name in pattern.groupindex if name != 'label'])
+    return labels.pop(), [sum([int(m.group(name)) for m in matches])
+        for name in names]
+
+### EOF
@@ -0,0 +1,81 @@
+# sweep.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sweep-line merge-join of position-sorted variants against
+# start-sorted reference intervals
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+
+
+"""Active-interval sweep over one chromosome
+   intervals is an iterable of (start, end, row) sorted by start (closed
+   intervals, same convention as u.isBetween). overlapping(pos) must be
+   called with non-decreasing positions; each interval is read once and
+   pushed/popped on the active heap once, so a whole chromosome costs
+   O(n + m + k) plus the heap operations.
+"""
+class IntervalSweep(object):
+
+    def __init__(self, intervals):
+        self.intervals = iter(intervals)
+        self.pending = next(self.intervals, None)
+        self.active = []   # heap of (end, seq, row)
+        self.seq = 0
+        self.last = None
+
+    """True if pos can be answered without going backwards
+    """
+    def canAdvance(self, pos):
+        return (self.last is None) or (pos >= self.last)
+
+    """Rows of all intervals containing pos, in interval stream order
+    """
+    def overlapping(self, pos):
+        if not self.canAdvance(pos):
+            raise ValueError(f"sweep position went backwards: {pos} < {self.last}")
+        self.last = pos
+
+        # Admit every interval starting at or before pos
+        while (self.pending is not None) and (self.pending[0] <= pos):
+            start, end, row = self.pending
+            if end >= start:
+                heapq.heappush(self.active, (end, self.seq, row))
+            self.seq = self.seq + 1
+            self.pending = next(self.intervals, None)
+
+        # Retire every interval ending before pos
+        while (len(self.active) > 0) and (self.active[0][0] < pos):
+            heapq.heappop(self.active)
+
+        return [row for (end, seq, row) in
+            sorted(self.active, key=lambda a: a[1])]
+
+    """Row of the first interval (in stream order) containing pos, or None
+    """
+    def first(self, pos):
+        rows = self.overlapping(pos)
+        if (len(rows) > 0):
+            return rows[0]
+        return None
+
+
+"""Sweep-line join of a variant stream with a reference interval stream
+   variants: iterable of (chrom, pos, item) sorted by chrom, then pos
+   intervals: function chrom -> iterable of (start, end, row) sorted by start
+   Yields (item, rows) for every variant, rows being all overlapping rows.
+"""
+def sweepOverlaps(variants, intervals):
+    chrom = None
+    sweep = None
+    for (c, pos, item) in variants:
+        if (c != chrom):
+            chrom = c
+            sweep = IntervalSweep(intervals(c))
+        yield (item, sweep.overlapping(pos))
+
+### EOF
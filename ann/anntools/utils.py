@@ -14,12 +14,15 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import json
 import pymysql
+import pymysql.cursors
 import boto3
 from botocore.exceptions import ClientError
 
 """Get connection to reference database
+   Pass cursorclass=pymysql.cursors.SSCursor for an unbuffered (streaming)
+   connection
 """
-def db_connect():
+def db_connect(cursorclass=pymysql.cursors.Cursor):
     AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
         ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
@@ -45,7 +48,30 @@ def db_connect():
         port=mysql_port,
         user=username,
         passwd=password,
-        db=database_name)
+        db=database_name,
+        cursorclass=cursorclass)
+
+
+"""Versions of reference tables, used for annotation provenance
+   The creation and last update time of each table identify the loaded
+   build, so a table reloaded in place (LOAD DATA, REPLACE, TRUNCATE or
+   DELETE and INSERT) gets a new version too. An update time the server
+   does not know (e.g. after a restart) is '.', which may look like a
+   change but never hides one. Tables whose version cannot be read get None
+"""
+def getTableVersions(cursor, tables):
+    versions = {}
+    for t in tables:
+        cursor.execute('select create_time, update_time ' + \
+            'from information_schema.tables ' + \
+            'where table_schema = database() and table_name = "' + t + '";')
+        row = cursor.fetchone()
+        if (row is None) or (row[0] is None):
+            versions[t] = None
+        else:
+            versions[t] = str(row[0]) + '/' + \
+                (str(row[1]) if row[1] is not None else '.')
+    return versions
 
 
 """Column inices for pileup and VCF
@@ -108,14 +134,26 @@ def dedup(mylist):
     return outlist
 
 
+"""Helper method to parse an INFO string into a dict in one pass
+   Keys match exactly ('name' does not match 'name2'); the first value of
+   a repeated key is kept and flags without a value map to ''
+"""
+def parse_info(text, sep1=';', sep2='='):
+    values = {}
+    for f in text.strip().split(sep1):
+        pairs = f.split(sep2, 1)
+        key = pairs[0].strip()
+        if (len(key) > 0) and (key not in values):
+            values[key] = pairs[1] if (len(pairs) > 1) else ''
+    return values
+
+
 """Helper method to parse fields
 """
 def parse_field(text, key, sep1, sep2):
-    fields = text.strip().split(sep1)
-    for f in fields:
-        pairs = f.split(sep2)
-        if (str(pairs[0]).find(str(key)) > -1):
-            return str(pairs[1])
-    return '.'
+    value = parse_info(text, sep1, sep2).get(str(key))
+    if (value is None) or (len(value) == 0):
+        return '.'
+    return str(value)
 
 ### EOF
\ No newline at end of file
@@ -0,0 +1,188 @@
+# vcf_sort.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Memory-bounded (external) sort of VCF records by chromosome and position
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import heapq
+import tempfile
+
+import file_utils as fu
+
+# Maximum number of records held in memory before a sorted run is spilled
+MAX_RECORDS = 500000
+
+CHROM_SPECIAL = {'X': 0, 'Y': 1, 'M': 2, 'MT': 2}
+
+
+"""Sort key for a chromosome name: 1..22, X, Y, M/MT, then anything else
+   "chr" prefix is ignored so chr1 and 1 sort together
+"""
+def chromKey(chrom):
+    c = str(chrom).strip()
+    if c.lower().startswith('chr'):
+        c = c[3:]
+    if c.isdigit():
+        return (0, int(c), '')
+    if c.upper() in CHROM_SPECIAL:
+        return (1, CHROM_SPECIAL[c.upper()], '')
+    return (2, 0, c)
+
+
+"""Sort key for a VCF record line: (chromosome, position)
+"""
+def recordKey(line, sep='\t'):
+    fields = line.split(sep, 2)
+    try:
+        pos = int(fields[1])
+    except (IndexError, ValueError):
+        pos = 0
+    return (chromKey(fields[0]), pos)
+
+
+"""Writes one sorted run of (linenum, line) pairs to a temporary file
+"""
+def spillRun(run, tmpdir=None):
+    fd, path = tempfile.mkstemp(prefix='anntools.', suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'w') as fh:
+        for (key, linenum, line) in run:
+            fh.write(str(linenum) + '\t' + line + '\n')
+    return path
+
+
+"""Reads a spilled run back, recomputing the sort key for each record
+"""
+def readRun(path, keyfn):
+    with open(path) as fh:
+        for l in fh:
+            linenum, line = l.rstrip('\n').split('\t', 1)
+            linenum = int(linenum)
+            yield (keyfn(linenum, line), linenum, line)
+
+
+"""External merge sort
+   records is an iterable of (linenum, line); keyfn(linenum, line) gives
+   the sort key. At most max_records are held in memory; larger inputs are
+   spilled to disk as sorted runs and k-way merged. Ties keep input order.
+   Yields (linenum, line) in sorted order.
+"""
+def externalSort(records, keyfn, max_records=MAX_RECORDS, tmpdir=None):
+    runs = []
+    buf = []
+    try:
+        for (linenum, line) in records:
+            buf.append((keyfn(linenum, line), linenum, line))
+            if len(buf) >= max_records:
+                buf.sort()
+                runs.append(spillRun(buf, tmpdir=tmpdir))
+                buf = []
+
+        buf.sort()
+        if len(runs) == 0:
+            for (key, linenum, line) in buf:
+                yield (linenum, line)
+            return
+
+        if len(buf) > 0:
+            runs.append(spillRun(buf, tmpdir=tmpdir))
+            buf = []
+
+        for (key, linenum, line) in heapq.merge(
+            *[readRun(path, keyfn) for path in runs]):
+            yield (linenum, line)
+    finally:
+        for path in runs:
+            fu.delete(path)
+
+
+"""Sorts a VCF file by (chrom, pos) with bounded memory
+   Header lines are copied first, in their original order. The original
+   line number of every record (1-based, records only) is written to
+   orderfile, one per line, in the same order as the sorted records, so the
+   annotated output can later be put back in input order with restoreOrder.
+   Returns the number of records.
+"""
+def sortVcf(infile, outfile, orderfile, max_records=MAX_RECORDS,
+    tmpdir=None, sep='\t'):
+
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+    headers = []
+    def records(fh):
+        linenum = 0
+        for line in fh:
+            line = line.rstrip('\r\n')
+            if line.startswith('#'):
+                headers.append(line)
+            elif len(line.strip()) > 0:
+                linenum = linenum + 1
+                yield (linenum, line)
+
+    count = 0
+    fh = open(infile)
+    fh_out = open(outfile, 'w')
+    fh_order = open(orderfile, 'w')
+    try:
+        sorted_records = externalSort(records(fh),
+            keyfn=lambda linenum, line: recordKey(line, sep=sep),
+            max_records=max_records, tmpdir=tmpdir)
+
+        # Input is fully consumed (and headers collected) once the first
+        # sorted record is available
+        first = next(sorted_records, None)
+        for h in headers:
+            fh_out.write(h + '\n')
+        if first is not None:
+            fh_out.write(first[1] + '\n')
+            fh_order.write(str(first[0]) + '\n')
+            count = 1
+        for (linenum, line) in sorted_records:
+            fh_out.write(line + '\n')
+            fh_order.write(str(linenum) + '\n')
+            count = count + 1
+    finally:
+        fh.close()
+        fh_out.close()
+        fh_order.close()
+
+    return count
+
+
+"""Puts records of a position-sorted file back in their original order
+   infile must hold exactly one record per line of orderfile, in the same
+   order (every annotation stage preserves this)
+"""
+def restoreOrder(infile, outfile, orderfile, max_records=MAX_RECORDS,
+    tmpdir=None):
+
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(outfile))
+
+    fh = open(infile)
+    fh_order = open(orderfile)
+    fh_out = open(outfile, 'w')
+    try:
+        def records():
+            for line in fh:
+                line = line.rstrip('\r\n')
+                if line.startswith('#'):
+                    fh_out.write(line + '\n')
+                elif len(line.strip()) > 0:
+                    yield (int(fh_order.readline()), line)
+
+        for (linenum, line) in externalSort(records(),
+            keyfn=lambda linenum, line: linenum,
+            max_records=max_records, tmpdir=tmpdir):
+            fh_out.write(line + '\n')
+    finally:
+        fh.close()
+        fh_order.close()
+        fh_out.close()
+
+### EOF
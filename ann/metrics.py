@@ -0,0 +1,128 @@
+# metrics.py
+#
+# Annotator load and throughput metrics for autoscaling
+#
+# Metrics are kept in process and exposed two ways, either or both of which
+# may be enabled in ann_config.ini [metrics]:
+#   * a Prometheus-style text endpoint served over HTTP (GET /metrics)
+#   * a statsd UDP emitter (gauges as |g, counters as |c, timings as |ms)
+##
+
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StatsdClient:
+
+    def __init__(self, host, port=8125, prefix=''):
+        self.address = (host, int(port))
+        self.prefix = f'{prefix}.' if prefix else ''
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+
+    def send(self, name, value, kind):
+        #UDP is fire-and-forget; a missing collector must never stall jobs
+        try:
+            self.sock.sendto(f'{self.prefix}{name}:{value}|{kind}'.encode(),
+                self.address)
+        except OSError as e:
+            print(f'statsd send failed: {e}')
+
+
+class Metrics:
+
+    def __init__(self, prefix='annotator', statsd=None):
+        self.prefix = prefix.replace('.', '_')
+        self.statsd = statsd
+        self.lock = threading.Lock()
+        self.gauges = {}
+        self.counters = {}
+        self.summaries = {}
+        self.server = None
+
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+        if self.statsd is not None:
+            self.statsd.send(name, value, 'g')
+
+
+    def incr(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        if self.statsd is not None:
+            self.statsd.send(name, amount, 'c')
+
+
+    def observe(self, name, value):
+        #Keeps count and sum, like a Prometheus summary without quantiles
+        with self.lock:
+            count, total = self.summaries.get(name, (0, 0.0))
+            self.summaries[name] = (count + 1, total + value)
+        if self.statsd is not None:
+            self.statsd.send(name, int(value * 1000), 'ms')
+
+
+    def mean(self, name, default=None):
+        with self.lock:
+            count, total = self.summaries.get(name, (0, 0.0))
+        return total / count if count else default
+
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} gauge')
+                lines.append(f'{self.prefix}_{name} {value}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.prefix}_{name}_total counter')
+                lines.append(f'{self.prefix}_{name}_total {value}')
+            for name, (count, total) in sorted(self.summaries.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} summary')
+                lines.append(f'{self.prefix}_{name}_count {count}')
+                lines.append(f'{self.prefix}_{name}_sum {total}')
+        return '\n'.join(lines) + '\n'
+
+
+    def serve(self, port, host=''):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, int(port)), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        print(f'Metrics served on port {self.server.server_address[1]}')
+        return self.server
+
+
+"""Metrics configured from a ConfigParser [metrics] section
+"""
+def from_config(config):
+    statsd = None
+    host = config.get('metrics', 'StatsdHost', fallback='')
+    if host:
+        statsd = StatsdClient(host, config.getint('metrics', 'StatsdPort',
+            fallback=8125), config.get('metrics', 'Prefix', fallback='annotator'))
+    metrics = Metrics(config.get('metrics', 'Prefix', fallback='annotator'),
+        statsd)
+    port = config.getint('metrics', 'PrometheusPort', fallback=0)
+    if port:
+        metrics.serve(port)
+    return metrics
@@ -0,0 +1,254 @@
+# ref_index.py
+#
+# Local reference indexes for the annotator
+#
+# A reference version is a directory under [reference] Root holding the
+# index files and a manifest.json that lists them:
+#   {"indexes": {"dbsnp_filter": {"file": "dbsnp_snv.bloom",
+#                                 "size": 123, "sha256": "..."}}}
+# Root/CURRENT names the version in use. The annotator loads every index of
+# that version at startup, in parallel and memory-mapped, and validates it
+# (size, checksum, and format for Bloom filters) before it polls SQS, so no
+# job pays for a cold load. Pointing CURRENT at a new version loads and
+# validates that version in the background and swaps it in once it is ready;
+# running jobs keep the files of the version they started with.
+#
+# Without a CURRENT file the [anntools] DbSnpFilter and ReferenceVersion
+# settings are used as before.
+##
+
+import os
+import sys
+import mmap
+import json
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from anntools import bloom
+
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'
+HASH_BLOCK = 8 * 1024 * 1024
+
+
+class ReferenceIndexError(Exception):
+    pass
+
+
+class MappedIndex:
+    #A read-only memory-mapped index file; bloom filters are mapped by
+    #BloomFilter.load, which also checks their header
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.bloom = None
+        self.fh = None
+        self.mapping = None
+        if path.endswith('.bloom'):
+            self.bloom = bloom.BloomFilter.load(path)
+            self.mapping = self.bloom.mapping
+        else:
+            self.fh = open(path, 'rb')
+            self.mapping = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, 'MADV_WILLNEED'):
+            self.mapping.madvise(mmap.MADV_WILLNEED)
+
+
+    def size(self):
+        return len(self.mapping)
+
+
+    def sha256(self):
+        #Reading every page also pulls the whole index into memory
+        digest = hashlib.sha256()
+        for offset in range(0, len(self.mapping), HASH_BLOCK):
+            digest.update(self.mapping[offset:offset + HASH_BLOCK])
+        return digest.hexdigest()
+
+
+    def close(self):
+        if self.bloom is not None:
+            self.bloom.close()
+        else:
+            self.mapping.close()
+            self.fh.close()
+
+
+class ReferenceSet:
+
+    def __init__(self, version, indexes):
+        #indexes maps each index name to {'path', and optionally 'size' and
+        #'sha256' to validate it against}
+        self.version = version
+        self.indexes = indexes
+        self.loaded = {}
+        self.load_seconds = 0.0
+
+
+    @classmethod
+    def from_directory(cls, version, directory):
+        try:
+            with open(os.path.join(directory, MANIFEST)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ReferenceIndexError(f'No manifest for reference {version}: {e}')
+        indexes = {}
+        for name, entry in manifest.get('indexes', {}).items():
+            indexes[name] = dict(entry, path=os.path.join(directory, entry['file']))
+        return cls(version, indexes)
+
+
+    def load(self, workers=4):
+        #Maps and validates every index in parallel; raises
+        #ReferenceIndexError (with nothing left mapped) if any is unusable
+        start = time.time()
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {name: pool.submit(load_index, name, entry)
+                for name, entry in self.indexes.items()}
+            for name, future in futures.items():
+                try:
+                    self.loaded[name] = future.result()
+                except Exception as e:
+                    errors.append(f'{name}: {e}')
+        if errors:
+            self.close()
+            raise ReferenceIndexError(
+                f"Reference {self.version} failed validation ({'; '.join(errors)})")
+        self.load_seconds = time.time() - start
+        return self
+
+
+    def paths(self):
+        return {name: entry['path'] for name, entry in self.indexes.items()}
+
+
+    def footprint(self):
+        #Bytes mapped for all loaded indexes
+        return sum(index.size() for index in self.loaded.values())
+
+
+    def close(self):
+        for index in self.loaded.values():
+            index.close()
+        self.loaded = {}
+
+
+def load_index(name, entry):
+    index = MappedIndex(name, entry['path'])
+    try:
+        if 'size' in entry and index.size() != entry['size']:
+            raise ReferenceIndexError(
+                f"size {index.size()} does not match manifest ({entry['size']})")
+        if 'sha256' in entry and index.sha256() != entry['sha256']:
+            raise ReferenceIndexError('checksum does not match manifest')
+    except Exception:
+        index.close()
+        raise
+    return index
+
+
+class ReferenceIndexes:
+    #The reference set in use, plus a background load of the next version
+    #when CURRENT changes
+
+    def __init__(self, root, fallback_version, fallback_indexes, workers=4):
+        self.root = root
+        self.fallback_version = fallback_version
+        self.fallback_indexes = fallback_indexes
+        self.workers = workers
+        self.current = None
+        self.staged = None
+        self.loading = None
+        self.failed = None
+        self.lock = threading.Lock()
+
+
+    def current_version(self):
+        #Version named by Root/CURRENT, or None to use the fallback settings
+        if not self.root:
+            return None
+        try:
+            with open(os.path.join(self.root, CURRENT)) as f:
+                return f.read().strip() or None
+        except OSError:
+            return None
+
+
+    def reference_set(self, version):
+        if version is None:
+            indexes = {}
+            for name, path in self.fallback_indexes.items():
+                if not path:
+                    continue
+                if not os.path.exists(path):
+                    print(f'Reference index {name} not found at {path}, not using it')
+                    continue
+                indexes[name] = {'path': path}
+            return ReferenceSet(self.fallback_version, indexes)
+        return ReferenceSet.from_directory(version, os.path.join(self.root, version))
+
+
+    def load(self):
+        #Loads the current version in the foreground (at startup)
+        self.current = self.reference_set(self.current_version()).load(self.workers)
+        return self.current
+
+
+    def check(self):
+        #Starts loading a newly published version; returns the new set once
+        #it has replaced the current one, otherwise None
+        with self.lock:
+            staged, self.staged = self.staged, None
+        if staged is not None:
+            previous, self.current = self.current, staged
+            previous.close()
+            return staged
+
+        version = self.current_version()
+        if version is None or self.current is None:
+            return None
+        if version in [self.current.version, self.loading, self.failed]:
+            return None
+        self.loading = version
+        threading.Thread(target=self.stage, args=(version,), daemon=True).start()
+        return None
+
+
+    def stage(self, version):
+        try:
+            staged = self.reference_set(version).load(self.workers)
+            print(f'Reference {version} loaded in {staged.load_seconds:.1f}s')
+            with self.lock:
+                self.staged = staged
+        except Exception as e:
+            print(f'Keeping reference {self.current.version}: {e}')
+            self.failed = version
+        finally:
+            self.loading = None
+
+
+"""Writes manifest.json for the index files in a reference version directory
+"""
+def write_manifest(directory, names):
+    indexes = {}
+    for name, file_name in names.items():
+        index = load_index(name, {'path': os.path.join(directory, file_name)})
+        indexes[name] = {'file': file_name, 'size': index.size(),
+            'sha256': index.sha256()}
+        index.close()
+    tmppath = os.path.join(directory, MANIFEST + '.tmp')
+    with open(tmppath, 'w') as f:
+        json.dump({'indexes': indexes}, f, indent=2)
+    os.replace(tmppath, os.path.join(directory, MANIFEST))
+
+
+if __name__ == '__main__':
+    # python ann/ref_index.py <version dir> dbsnp_filter=dbsnp_snv.bloom ...
+    if len(sys.argv) > 2:
+        write_manifest(sys.argv[1], dict(arg.split('=', 1) for arg in sys.argv[2:]))
+        print(f'Wrote {os.path.join(sys.argv[1], MANIFEST)}')
+    else:
+        print('Usage: ref_index.py <version dir> <name>=<file> [<name>=<file> ...]')
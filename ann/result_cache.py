@@ -0,0 +1,64 @@
+# result_cache.py
+#
+# Index of completed annotations keyed by input file content hash
+#
+# Lets the annotator skip re-annotating an input that has already been
+# annotated against the same reference data; the stored result and log
+# objects are copied in S3 instead. Backed by a local SQLite file that is
+# shared by annotator.py and the run.py processes it spawns.
+##
+
+import os
+import time
+import sqlite3
+
+
+class ResultCache:
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.execute('''create table if not exists results (
+            input_hash text not null,
+            reference_version text not null,
+            bucket text not null,
+            s3_key_result_file text not null,
+            s3_key_log_file text not null,
+            created real not null,
+            primary key (input_hash, reference_version))''')
+
+
+    def execute(self, sql, params=()):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                return conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+
+
+    def lookup(self, input_hash, reference_version):
+        row = self.execute('''select bucket, s3_key_result_file, s3_key_log_file
+            from results where input_hash = ? and reference_version = ?''',
+            (input_hash, reference_version))
+        if row is None:
+            return None
+        return {
+            'bucket': row[0],
+            's3_key_result_file': row[1],
+            's3_key_log_file': row[2]
+        }
+
+
+    def record(self, input_hash, reference_version, bucket, s3_key_result, s3_key_log):
+        self.execute('insert or replace into results values (?, ?, ?, ?, ?, ?)',
+            (input_hash, reference_version, bucket, s3_key_result,
+            s3_key_log, time.time()))
+
+
+    def forget(self, input_hash, reference_version):
+        self.execute('''delete from results
+            where input_hash = ? and reference_version = ?''',
+            (input_hash, reference_version))
@@ -15,16 +15,30 @@ anntools_path = os.path.join(os.path.dirname(__file__), 'anntools')
 sys.path.append(anntools_path)
 
 import driver
+import checkpoint
 import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 from flask import session
 from configparser import ConfigParser
 import json
+from result_cache import ResultCache
+import s3_transfer
+import scratch
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 config_path = os.path.join(current_dir, 'ann_config.ini')
 config = ConfigParser(os.environ)
 config.read(config_path)
 
+#Bounded retries with backoff for every AWS call on the completion path
+aws_config = Config(
+  region_name=config['aws']['AwsRegionName'],
+  retries={
+    'max_attempts': config.getint('aws', 'MaxAttempts', fallback=5),
+    'mode': 'standard'
+  })
+
 """A rudimentary timer for coarse-grained profiling
 """
 class Timer(object):
@@ -41,95 +55,203 @@ class Timer(object):
     if self.verbose:
       print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+"""Job details saved by the annotator next to the input file
+(the job request message plus the input content hash)
+"""
+def load_job(file_path):
+  job_path = f"{file_path.split('.')[0]}.json"
+  try:
+    with open(job_path) as f:
+      return json.load(f)
+  except Exception as e:
+    print(f'No job details for {file_path}: {e}')
+    return {}
+
+"""Mark the job completed in DynamoDB and notify the results topic
+The update returns the whole new item, so no re-read is needed
+"""
+def complete_job(table, job_id, bucket, s3_key_result, s3_key_log,
+  s3_key_index=None):
+  #Update Dynamo DB Table
+  update_expression = '''set s3_key_result_file = :results,
+                          s3_key_log_file = :log,
+                          s3_results_bucket = :rbucket,
+                          complete_time = :ct,
+                          job_status = :status'''
+  values = {
+    ':results': s3_key_result,
+    ':log': s3_key_log,
+    ':rbucket': bucket,
+    ':ct': str(time.time()),
+    ':status': 'COMPLETED'
+  }
+  #Positional index of the result, for region queries
+  if s3_key_index is not None:
+    update_expression += ', s3_key_index_file = :index'
+    values[':index'] = s3_key_index
+  try:
+    #https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
+    response = table.update_item(
+      Key={'job_id': job_id},
+      UpdateExpression=update_expression,
+      ExpressionAttributeValues=values,
+      ReturnValues="ALL_NEW"
+      )
+    updated_data = response['Attributes']
+    print(f'Job Information Added to Table {table}')
+  except Exception as e:
+    table.update_item(
+          Key={'job_id': job_id},
+          UpdateExpression='set job_status = :correct',
+          ExpressionAttributeValues={':false': 'RUNNING', ':correct':'PENDING'},
+          ConditionExpression='job_status = :false',
+          ReturnValues="UPDATED_NEW"
+          )
+    print(f'DynamoDB Update Failed because {e}')
+    return
+
+  #Send message to result topic
+  #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+  sns = boto3.client('sns', config=aws_config)
+  #https://stackoverflow.com/questions/34029251/aws-publish-sns-message-for-lambda-function-via-boto3-python2
+  sns_message = json.dumps({'default': json.dumps(updated_data)})
+  try:
+    sns_topic_response = sns.publish(
+        TopicArn=config['sns']['SnsResultsTopic'],
+        Message=sns_message,
+        MessageStructure='json'
+    )
+    print('Message published to sns results')
+  except Exception as e:
+    print(f"Unable to publish sns results message: {e}")
+
 if __name__ == '__main__':
   # Call the AnnTools pipeline
   if len(sys.argv) > 1:
-    with Timer():
-      driver.run(sys.argv[1], 'vcf')
-
     #File and Job Information
     bucket = config['s3']['ResultsBucket']
     file_path = sys.argv[1]
     clean_path = file_path.split('.')[0]
-    annot_file_path = f'{clean_path}.annot.vcf'
-    log_file_path = f'{clean_path}.vcf.count.log'
-    annot_file_name = os.path.basename(annot_file_path)
-    log_file_name = os.path.basename(log_file_path)
+    job_file_path = f'{clean_path}.json'
+    stats_file_path = f'{clean_path}.stats.json'
     job_id = clean_path.split('/')[-1]
+    job = load_job(file_path)
 
-    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(config['dynamo']['Table'])
-    response = table.get_item(Key={'job_id': job_id})
-    user_id = response['Item']['user_id']
-    folder_prexix = config['s3']['FolderPrefix']
+    #An optional second argument runs the job in that many parallel shards
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    options = {
+      'sort_input': config.getboolean('anntools', 'SortInput', fallback=False),
+      'sort_max_records': config.getint('anntools', 'SortMaxRecords',
+        fallback=500000),
+      'sweep_min_records': config.getint('anntools', 'SweepMinRecords',
+        fallback=10000),
+      #Indexes of the reference version the annotator assigned to this job
+      'dbsnp_filter': job.get('reference_indexes', {}).get('dbsnp_filter',
+        config.get('anntools', 'DbSnpFilter', fallback=None)) or None
+    }
 
+    #Intermediate files live in a per-job scratch directory (tmpfs or local
+    #NVMe) that is removed however the job ends
+    scratch_root = scratch.scratch_root(
+      config.get('scratch', 'Root', fallback=None),
+      os.path.join(os.path.dirname(os.path.abspath(file_path)), 'scratch'))
+    job_scratch = scratch.JobScratch(job_id, scratch_root,
+      quota_bytes=config.getint('scratch', 'QuotaMB', fallback=0) * 1024 * 1024)
+    with job_scratch:
+      work_path = job_scratch.adopt(file_path)
+      annot_file_path = os.path.join(job_scratch.path, f'{job_id}.annot.vcf')
+      index_file_path = f'{annot_file_path}.idx'
+      log_file_path = f'{work_path}.count.log'
+      annot_file_name = os.path.basename(annot_file_path)
+      log_file_name = os.path.basename(log_file_path)
 
+      #Resume a redelivered job from its last completed step; the checkpoint
+      #is stored outside the scratch directory, which does not outlive the job
+      job_ck = None
+      if config.getboolean('checkpoint', 'Enabled', fallback=False):
+        if config.getboolean('checkpoint', 'MirrorToS3', fallback=False):
+          store = checkpoint.S3Store(
+            s3_transfer.s3_client(),
+            config['s3']['ResultsBucket'],
+            f"{config['s3']['FolderPrefix']}/{config['checkpoint']['Prefix']}/{job_id}",
+            transfer_config=s3_transfer.transfer_config)
+        else:
+          store = checkpoint.LocalStore(os.path.join(
+            os.path.dirname(os.path.abspath(file_path)), 'checkpoints', job_id))
+        job_ck = checkpoint.Checkpoint(work_path, store=store)
+        job_ck.restore()
+      options['checkpoint'] = job_ck
 
-    #Upload Files to S3
-    s3_key_result = f'{folder_prexix}/{user_id}/{annot_file_name}'
-    s3_key_log = f'{folder_prexix}/{user_id}/{log_file_name}'
-    try:
-      #https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
-      s3.upload_file(annot_file_path, bucket, s3_key_result)
-      s3.upload_file(log_file_path, bucket, s3_key_log)
-      print('Files Uploaded Successfully')
-    except Exception as e:
-      print(f'S3 Upload Failed: {e}')
-    
-    #Update Dynamo DB Table
-    try:
-      #https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GettingStarted.UpdateItem.html
-      table.update_item(
-        Key={'job_id': job_id},
-        UpdateExpression='''set s3_key_result_file = :results, 
-                            s3_key_log_file = :log,
-                            s3_results_bucket = :rbucket,
-                            complete_time = :ct, 
-                            job_status = :status''',
-        ExpressionAttributeValues={
-          ':results': s3_key_result,
-          ':log': s3_key_log,
-          ':rbucket': bucket,
-          ':ct': str(time.time()),
-          ':status': 'COMPLETED'
-        },
-        ReturnValues="UPDATED_NEW"
-        )
-      print(f'Job Information Added to Table {table}')
-    except Exception as e:
-      table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression='set job_status = :correct',
-            ExpressionAttributeValues={':false': 'RUNNING', ':correct':'PENDING'},
-            ConditionExpression='job_status = :false',
-            ReturnValues="UPDATED_NEW"
-            )
-      print(f'DynamoDB Update Failed because {e}')
-    
-    #Send message to result topic
-    updated_response = table.get_item(Key={'job_id': job_id})
-    updated_data = updated_response['Item']
-    #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-    sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
-    #https://stackoverflow.com/questions/34029251/aws-publish-sns-message-for-lambda-function-via-boto3-python2
-    sns_message = json.dumps({'default': json.dumps(updated_data)})
+      with Timer() as timer:
+        if shards > 1:
+          nrecords = driver.runSharded(work_path, 'vcf', shards, **options)
+        else:
+          nrecords = driver.run(work_path, 'vcf', **options)
+
+      dynamo = boto3.resource('dynamodb', config=aws_config)
+      table = dynamo.Table(config['dynamo']['Table'])
+      #The job request carries the user; only look it up for older jobs
+      user_id = job.get('user_id')
+      if user_id is None:
+        response = table.get_item(Key={'job_id': job_id})
+        user_id = response['Item']['user_id']
+      folder_prexix = config['s3']['FolderPrefix']
+
+      #Upload result, log and index to S3 concurrently
+      s3_key_result = f'{folder_prexix}/{user_id}/{annot_file_name}'
+      s3_key_log = f'{folder_prexix}/{user_id}/{log_file_name}'
+      s3_key_index = f'{s3_key_result}.idx'
+      uploaded = False
+      #The index is optional: without it readers scan the result
+      index_upload = None
+      try:
+        #https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-uploading-files.html
+        with ThreadPoolExecutor(max_workers=3) as pool:
+          uploads = [
+            pool.submit(s3_transfer.upload, annot_file_path, bucket, s3_key_result),
+            pool.submit(s3_transfer.upload, log_file_path, bucket, s3_key_log)
+          ]
+          if os.path.exists(index_file_path):
+            index_upload = pool.submit(s3_transfer.upload, index_file_path,
+              bucket, s3_key_index)
+          for upload in uploads:
+            upload.result()
+        uploaded = True
+        print('Files Uploaded Successfully')
+      except Exception as e:
+        print(f'S3 Upload Failed: {e}')
+      if index_upload is None or index_upload.exception() is not None:
+        print('Result index not uploaded')
+        s3_key_index = None
+
+      complete_job(table, job_id, bucket, s3_key_result, s3_key_log,
+        s3_key_index)
+      if job_ck is not None:
+        job_ck.clear()
+
+    #Remember the result so identical inputs can reuse it
+    if uploaded and job.get('input_hash') and \
+      config.getboolean('cache', 'Enabled', fallback=False):
+      try:
+        ResultCache(config['cache']['ResultsIndex']).record(
+          job['input_hash'], job['reference_version'],
+          bucket, s3_key_result, s3_key_log)
+        print('Result recorded in results index')
+      except Exception as e:
+        print(f'Could not record result in results index: {e}')
+
+    #Job cost for the annotator's throughput metrics (it removes this file)
     try:
-      sns_topic_response = sns.publish(
-          TopicArn=config['sns']['SnsResultsTopic'],
-          Message=sns_message,
-          MessageStructure='json'
-      )
-      print('Message published to sns results')
+      with open(stats_file_path, 'w') as f:
+        json.dump({'job_id': job_id, 'records': nrecords,
+          'seconds': timer.secs, 'scratch_peak_bytes': job_scratch.peak}, f)
     except Exception as e:
-      print(f"Unable to publish sns results message: {e}")
-    
-      
-    #Remove Files From Annotator EC2 Instance
+      print(f'Could not write job stats: {e}')
+
+    #Remove the job details (the scratch directory is already gone)
     try:
-      os.remove(annot_file_path)
-      os.remove(log_file_path)
-      os.remove(file_path)
+      if os.path.exists(job_file_path):
+        os.remove(job_file_path)
       print('Files Deleted Successfully')
     except Exception as e:
       print(f'Could Not Delete Files: {e}')
@@ -137,4 +259,4 @@ if __name__ == '__main__':
   else:
     print("A valid .vcf file must be provided as input to this program.")
 
-### EOF
\ No newline at end of file
+### EOF
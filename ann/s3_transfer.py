@@ -0,0 +1,79 @@
+# s3_transfer.py
+#
+# Shared S3 client and multipart transfer settings for the annotator
+#
+# One client (and so one connection pool) per process, sized for the
+# transfer concurrency, plus a TransferConfig so large inputs and results
+# move as parallel multipart transfers instead of one stream. Settings are
+# in ann_config.ini [s3transfer].
+##
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+from configparser import ConfigParser
+config = ConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config.ini'))
+
+MB = 1024 * 1024
+
+transfer_config = TransferConfig(
+    multipart_threshold=config.getint('s3transfer', 'MultipartThresholdMB',
+        fallback=16) * MB,
+    multipart_chunksize=config.getint('s3transfer', 'MultipartChunkSizeMB',
+        fallback=16) * MB,
+    max_concurrency=config.getint('s3transfer', 'MaxConcurrency', fallback=10),
+    use_threads=True)
+
+_client = None
+_lock = threading.Lock()
+
+
+def s3_client():
+    #Created once; boto3 clients are safe to share between threads
+    global _client
+    with _lock:
+        if _client is None:
+            _client = boto3.client('s3', config=Config(
+                region_name=config['aws']['AwsRegionName'],
+                max_pool_connections=config.getint('s3transfer',
+                    'MaxPoolConnections', fallback=50),
+                retries={
+                    'max_attempts': config.getint('aws', 'MaxAttempts',
+                        fallback=5),
+                    'mode': 'standard'
+                }))
+        return _client
+
+
+class _StreamWriter:
+    #Write-only (non-seekable) target: s3transfer then downloads parts in
+    #parallel but hands them over in order, so they can be hashed as they
+    #are written
+    def __init__(self, fh, on_chunk=None):
+        self.fh = fh
+        self.on_chunk = on_chunk
+
+    def write(self, data):
+        if self.on_chunk is not None:
+            self.on_chunk(data)
+        return self.fh.write(data)
+
+
+def download(bucket, key, path, on_chunk=None):
+    with open(path, 'wb') as f:
+        s3_client().download_fileobj(bucket, key, _StreamWriter(f, on_chunk),
+            Config=transfer_config)
+
+
+def upload(path, bucket, key, extra_args=None):
+    s3_client().upload_file(path, bucket, key, ExtraArgs=extra_args,
+        Config=transfer_config)
+
+
+def copy(source_bucket, source_key, bucket, key):
+    s3_client().copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key,
+        Config=transfer_config)
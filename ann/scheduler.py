@@ -0,0 +1,65 @@
+# scheduler.py
+#
+# Priority-aware job scheduling for the annotator
+#
+# Jobs wait in one lane per class (e.g. premium and free). Whenever a worker
+# slot is free the next job is picked by smooth weighted round robin over
+# the lanes that have work, so each lane gets slots in proportion to its
+# weight. A lane may also reserve slots: other lanes can never use them, so
+# a premium job arriving during a burst of free jobs always finds a slot.
+##
+
+import time
+from collections import deque
+
+
+class JobScheduler:
+
+    def __init__(self, slots, weights, reserved=None):
+        self.slots = slots
+        self.weights = weights
+        self.reserved = reserved or {}
+        self.lanes = {lane: deque() for lane in weights}
+        self.credit = {lane: 0 for lane in weights}
+
+
+    def submit(self, lane, item):
+        self.lanes[lane].append((time.time(), item))
+
+
+    def pending(self, lane=None):
+        if lane is not None:
+            return len(self.lanes[lane])
+        return sum(len(jobs) for jobs in self.lanes.values())
+
+
+    def has_slot(self, lane, running):
+        #Free slots left after holding back other lanes' unused reservations
+        free = self.slots - sum(running.values())
+        held = sum(max(0, self.reserved.get(other, 0) - running.get(other, 0))
+            for other in self.lanes if other != lane)
+        return free - held > 0
+
+
+    def next_job(self, running):
+        #Next (lane, item, seconds waited), or None if nothing can run now;
+        #running maps each lane to its number of jobs currently running
+        eligible = [lane for lane, jobs in self.lanes.items()
+            if jobs and self.has_slot(lane, running)]
+        if not eligible:
+            return None
+
+        total = sum(self.weights[lane] for lane in eligible)
+        for lane in eligible:
+            self.credit[lane] += self.weights[lane]
+        lane = max(eligible, key=lambda l: self.credit[l])
+        self.credit[lane] -= total
+
+        queued, item = self.lanes[lane].popleft()
+        return (lane, item, time.time() - queued)
+
+
+    def items(self):
+        for jobs in self.lanes.values():
+            for queued, item in jobs:
+                yield item
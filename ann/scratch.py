@@ -0,0 +1,183 @@
+# scratch.py
+#
+# Per-job scratch directories for annotation runs
+#
+# Each run.py job works in its own directory under a scratch root, which
+# can be on tmpfs (/dev/shm) or a local NVMe volume so the pipeline's
+# intermediate files stay off EBS. Usage is sampled in the background to
+# enforce a quota and report the job's peak; the directory is removed on
+# every exit path, including exceptions and SIGTERM/SIGHUP. A job over its
+# quota is stopped right away, even while it waits in a database read or on
+# its shard processes: those processes are terminated and the main thread
+# gets a signal, which interrupts the blocking call; a job still running
+# after a grace period is killed outright. Directories left behind by
+# killed jobs (SIGKILL, instance restarts) are removed by sweep() when the
+# annotator starts.
+##
+
+import os
+import time
+import shutil
+import signal
+import threading
+import multiprocessing
+
+PID_FILE = '.pid'
+
+
+class ScratchQuotaExceeded(Exception):
+    pass
+
+
+class JobScratch:
+
+    def __init__(self, job_id, root, quota_bytes=0, interval=1.0, grace=30.0):
+        self.path = os.path.join(root, job_id)
+        self.quota_bytes = quota_bytes
+        self.interval = interval
+        self.grace = grace
+        self.peak = 0
+        self.exceeded = False
+        self.exceeded_at = None
+        self.stopped = threading.Event()
+        self.monitor = None
+        self.handlers = {}
+
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, PID_FILE), 'w') as f:
+            f.write(str(os.getpid()))
+
+        #Turn termination signals into SystemExit so cleanup still runs
+        for signum in [signal.SIGTERM, signal.SIGHUP]:
+            self.handlers[signum] = signal.signal(signum, self.terminate)
+        #Sent to the main thread by the monitor when the quota is exceeded
+        self.handlers[signal.SIGUSR1] = signal.signal(signal.SIGUSR1,
+            self.quota_exceeded)
+
+        self.monitor = threading.Thread(target=self.watch, daemon=True)
+        self.monitor.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+        return False
+
+
+    def terminate(self, signum, frame):
+        raise SystemExit(128 + signum)
+
+
+    def quota_exceeded(self, signum, frame):
+        raise ScratchQuotaExceeded(
+            f'Scratch quota of {self.quota_bytes} bytes exceeded')
+
+
+    def usage(self):
+        total = 0
+        for directory, dirs, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(directory, name)).st_size
+                except OSError:
+                    pass
+        return total
+
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            if self.exceeded_at is not None:
+                if time.time() - self.exceeded_at > self.grace:
+                    #The job ignored the interruption; remove its files and
+                    #kill it rather than let scratch grow
+                    print(f'Job still running {self.grace}s after exceeding '
+                        'its scratch quota, killing it')
+                    shutil.rmtree(self.path, ignore_errors=True)
+                    os._exit(1)
+                continue
+            self.sample()
+
+
+    def sample(self):
+        used = self.usage()
+        self.peak = max(self.peak, used)
+        if self.quota_bytes and used > self.quota_bytes and not self.exceeded:
+            print(f'Scratch usage {used} bytes exceeds quota {self.quota_bytes}')
+            self.exceeded = True
+            self.exceeded_at = time.time()
+            self.stop_job()
+
+
+    def stop_job(self):
+        #Child processes (e.g. annotation shards) stop writing now; a signal
+        #to the main thread interrupts whatever call it is blocked in
+        for child in multiprocessing.active_children():
+            child.terminate()
+        signal.pthread_kill(threading.main_thread().ident, signal.SIGUSR1)
+
+
+    def adopt(self, file_path):
+        #Move an input into the scratch directory; returns its new path
+        dest = os.path.join(self.path, os.path.basename(file_path))
+        shutil.move(file_path, dest)
+        return dest
+
+
+    def cleanup(self):
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.join()
+            self.monitor = None
+        if os.path.isdir(self.path):
+            #Only record the final size; the job is already over
+            self.peak = max(self.peak, self.usage())
+            shutil.rmtree(self.path, ignore_errors=True)
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+        self.handlers = {}
+        print(f'Peak scratch usage: {self.peak} bytes')
+        return self.peak
+
+
+"""Root directory for job scratch space, falling back to fallback when the
+configured root (e.g. tmpfs or NVMe) cannot be used
+"""
+def scratch_root(root, fallback):
+    for path in [root, fallback]:
+        if not path:
+            continue
+        try:
+            os.makedirs(path, exist_ok=True)
+            if os.access(path, os.W_OK):
+                return path
+        except OSError as e:
+            print(f'Scratch root {path} unavailable: {e}')
+    return fallback
+
+
+"""Removes scratch directories whose job process is no longer running
+"""
+def sweep(root):
+    removed = 0
+    if not os.path.isdir(root):
+        return removed
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not os.path.isdir(path):
+            continue
+        try:
+            with open(os.path.join(path, PID_FILE)) as f:
+                os.kill(int(f.read().strip()), 0)
+            continue
+        except PermissionError:
+            #Alive, owned by another user
+            continue
+        except (OSError, ValueError):
+            pass
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    if removed:
+        print(f'Removed {removed} stale scratch directories from {root}')
+    return removed
@@ -12,7 +12,9 @@ import sys
 import time
 import boto3
 import json
+import math
 import time
+import tempfile
 
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
@@ -25,21 +27,25 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'archive_co
 
 def glacierArchive(job_data):
     
-    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    s3 = helpers.s3_client()
     glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
     dynamodb = boto3.client('dynamodb', region_name=config['aws']['AwsRegionName'])
     glacier_vault = config['glacier']['VaultName']
     bucket = config['s3']['ResultsBucket']
     result_filename = job_data['s3_key_result_file']
 
+    #Spool the result to a local file with a parallel multipart download
+    #rather than reading it into memory as one stream
+    file_data = tempfile.TemporaryFile()
     try:
-        result_file = s3.get_object(Bucket=bucket, 
-                                    Key=result_filename
-                                    )
-        file_data = result_file['Body'].read()
+        #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/download_fileobj.html
+        s3.download_fileobj(bucket, result_filename, file_data,
+                            Config=helpers.transfer_config)
+        file_data.seek(0)
 
     except Exception as e:
         print(f'Error error getting file data: {e}')
+        file_data.close()
         return False
     
     try:
@@ -54,6 +60,8 @@ def glacierArchive(job_data):
     except Exception as e:
         print(f'Error uploading to glacier: {e}')
         return False
+    finally:
+        file_data.close()
     
     try:
         #Update DynamoDB
@@ -95,6 +103,26 @@ def glacierArchive(job_data):
 
     return True
 
+def archive_delay(data):
+    #Seconds until a free user's result is due for archiving
+    complete_time = float(data['complete_time'])
+    grace = int(config['archive']['GraceSeconds'])
+    return max(0, math.ceil(complete_time + grace - time.time()))
+
+def defer_message(sqs, sqs_url, msg, delay):
+    #Hide the message until it is due instead of receiving it over and over;
+    #SQS caps a visibility timeout at 12 hours, so longer waits come back
+    #once per 12 hours
+    #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/change_message_visibility.html
+    try:
+        sqs.change_message_visibility(
+            QueueUrl=sqs_url,
+            ReceiptHandle=msg['ReceiptHandle'],
+            VisibilityTimeout=min(delay, 43200)
+        )
+    except Exception as e:
+        print(f'Error deferring message {e}')
+
 def SQS_message_reciever(sqs_url):
     sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
     print(f'SQS Message Reciever Listening on {sqs_url}')
@@ -116,10 +144,11 @@ def SQS_message_reciever(sqs_url):
                 data = json.loads(msg_body['Message'])
                
                 if data['user_role'] == 'free_user':
-                    current_time = int(time.time())
-                    complete_time = int(float(data['complete_time']))
-
-                    if (current_time - complete_time) > 300:
+                    delay = archive_delay(data)
+                    if delay > 0:
+                        print(f'Archiving {message_id} in {delay}s')
+                        defer_message(sqs, sqs_url, msg, delay)
+                    else:
                         print('Archiving in Glacier')
                         success = glacierArchive(data)
                         if success:
@@ -146,8 +175,6 @@ def SQS_message_reciever(sqs_url):
                     except Exception as e:
                         print(f'Error deleting message {e}')
 
-        time.sleep(10)
-
 if __name__ == '__main__':
     sqs_url = config['sqs']['ArchiveUrl']
     SQS_message_reciever(sqs_url)
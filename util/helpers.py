@@ -18,6 +18,36 @@ from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
 
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+MB = 1024 * 1024
+
+"""Multipart transfer settings shared by the utilities (util_config.ini
+[s3transfer])
+"""
+transfer_config = TransferConfig(
+  multipart_threshold=config.getint('s3transfer', 'MultipartThresholdMB',
+    fallback=16) * MB,
+  multipart_chunksize=config.getint('s3transfer', 'MultipartChunkSizeMB',
+    fallback=16) * MB,
+  max_concurrency=config.getint('s3transfer', 'MaxConcurrency', fallback=10),
+  use_threads=True)
+
+_s3_client = None
+
+"""S3 client shared by all callers in the process (one connection pool)
+"""
+def s3_client():
+  global _s3_client
+  if _s3_client is None:
+    _s3_client = boto3.client('s3', config=Config(
+      region_name=config['aws']['AwsRegionName'],
+      max_pool_connections=config.getint('s3transfer', 'MaxPoolConnections',
+        fallback=50)))
+  return _s3_client
+
+
 """Send email via Amazon SES
 """
 def send_email_ses(recipients=None, 
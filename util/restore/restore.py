@@ -11,6 +11,7 @@ import os
 import sys
 import time
 import boto3
+import boto3.dynamodb.conditions
 import json
 import time
 
@@ -55,6 +56,95 @@ def glacier_restore(archive_id):
 
     return job_id, True
 
+def archived_jobs(user_id):
+    #All of the user's jobs with archived results, following pagination
+    dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+    table = dynamo.Table(config['dynamo']['Table'])
+    query = {
+        'IndexName': config['dynamo']['UserIndex'],
+        'KeyConditionExpression': boto3.dynamodb.conditions.Key('user_id').eq(user_id),
+        'ProjectionExpression': 'job_id, user_id, results_file_archive_id, s3_key_result_file'
+    }
+    jobs = []
+    while True:
+        #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/query.html
+        response = table.query(**query)
+        jobs.extend([job for job in response['Items'] if 'results_file_archive_id' in job])
+        if 'LastEvaluatedKey' not in response:
+            return jobs
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def fan_out(sqs, sqs_url, user_id):
+    #Expand a restore-user event into one restore message per archived job,
+    #queued in batches of 10; returns False if any could not be queued
+    jobs = archived_jobs(user_id)
+    print(f'Restoring {len(jobs)} archived results for user {user_id}')
+    ok = True
+    for i in range(0, len(jobs), 10):
+        #Same body as an SNS notification, so each is handled like one
+        entries = [{
+            'Id': str(n),
+            'MessageBody': json.dumps({
+                'MessageId': f"{job['job_id']}-restore",
+                'Message': json.dumps(job)
+            })
+        } for n, job in enumerate(jobs[i:i + 10])]
+        ok = send_batch(sqs, sqs_url, entries) and ok
+    return ok
+
+
+def send_batch(sqs, sqs_url, entries, attempts=3):
+    #Queue entries, resending only the ones SQS did not accept
+    for attempt in range(attempts):
+        if attempt > 0:
+            time.sleep(2 ** attempt)
+        try:
+            #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs/client/send_message_batch.html
+            response = sqs.send_message_batch(QueueUrl=sqs_url, Entries=entries)
+        except Exception as e:
+            print(f'Error queueing restores: {e}')
+            continue
+        failed = set([failure['Id'] for failure in response.get('Failed', [])])
+        for failure in response.get('Failed', []):
+            print(f"Could not queue restore: {failure.get('Message')}")
+        entries = [entry for entry in entries if entry['Id'] in failed]
+        if len(entries) == 0:
+            return True
+    return False
+
+
+def claim_restore(job_id, archive_id):
+    #Record the retrieval of archive_id for the job unless it is already
+    #requested, so a repeated restore message does not start another one
+    dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+    table = dynamo.Table(config['dynamo']['Table'])
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='set restore_archive_id = :a',
+            ConditionExpression='attribute_not_exists(restore_archive_id) '
+                'OR restore_archive_id <> :a',
+            ExpressionAttributeValues={':a': archive_id}
+        )
+    except dynamo.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def release_restore(job_id):
+    #Let a later message retry a retrieval that could not be started
+    dynamo = boto3.resource('dynamodb', region_name=config['aws']['AwsRegionName'])
+    table = dynamo.Table(config['dynamo']['Table'])
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='remove restore_archive_id'
+        )
+    except Exception as e:
+        print(f'Error releasing restore of {job_id}: {e}')
+
+
 def SQS_message_reciever(sqs_url):
     sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
     sns = boto3.client('sns', region_name=config['aws']['AwsRegionName'])
@@ -77,11 +167,38 @@ def SQS_message_reciever(sqs_url):
 
                 message_id = msg_body['MessageId']
                 data = json.loads(msg_body['Message'])
+
+                #One event per upgraded user; expanded here into per-job
+                #restore messages
+                if data.get('type') == 'restore-user':
+                    if fan_out(sqs, sqs_url, data['user_id']):
+                        sqs.delete_message(
+                            QueueUrl=sqs_url,
+                            ReceiptHandle=msg['ReceiptHandle']
+                        )
+                        print(f'Message {message_id} Deleted from Queue')
+                    continue
+
                 archive_id = data['results_file_archive_id']
                 user_id = data['user_id']
                 filename = data['s3_key_result_file']
 
+                try:
+                    claimed = claim_restore(data['job_id'], archive_id)
+                except Exception as e:
+                    print(f'Error recording restore request: {e}')
+                    continue
+                if not claimed:
+                    print(f"Restore of {data['job_id']} already requested")
+                    sqs.delete_message(
+                        QueueUrl=sqs_url,
+                        ReceiptHandle=msg['ReceiptHandle']
+                    )
+                    continue
+
                 job_id, success = glacier_restore(archive_id)
+                if not success:
+                    release_restore(data['job_id'])
 
                 if success:
                     receipt = msg['ReceiptHandle']
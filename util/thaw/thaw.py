@@ -25,7 +25,7 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'thaw_confi
 
 def glacier_thaw(job_id, archive_id, filename):
     
-    s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
+    s3 = helpers.s3_client()
     glacier = boto3.client('glacier', region_name=config['aws']['AwsRegionName'])
     sqs = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
 
@@ -45,15 +45,19 @@ def glacier_thaw(job_id, archive_id, filename):
                 vaultName=config['glacier']['VaultName'],
                 jobId=job_id
             )
-            file_body = file['body'].read() 
 
             try:
-                response = s3.put_object(
-                    Bucket=config['s3']['ResultsBucket'], 
-                    Key=filename,
-                    Body=file_body,
-                    ServerSideEncryption=encryption,
-                    ACL=acl
+                #Stream the archive into a parallel multipart upload
+                #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/upload_fileobj.html
+                s3.upload_fileobj(
+                    file['body'],
+                    config['s3']['ResultsBucket'],
+                    filename,
+                    ExtraArgs={
+                        'ServerSideEncryption': encryption,
+                        'ACL': acl
+                    },
+                    Config=helpers.transfer_config
                     )
                 print('Uploaded restored file to S3')
             except Exception as e:
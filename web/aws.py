@@ -0,0 +1,69 @@
+# aws.py
+#
+# Shared AWS clients for the GAS web server
+#
+# Creating a boto3 client resolves credentials, loads the service model and
+# opens a new connection pool, so views get their clients from here instead:
+# one client per service per worker process, with a pool sized for the
+# worker's threads and TCP keep-alive. Clients are thread-safe; boto3
+# resources are not, so DynamoDB tables are kept per thread. A process forked
+# after clients were created (e.g. a gunicorn worker with --preload) builds
+# its own.
+##
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+from gas import app
+
+_lock = threading.Lock()
+_local = threading.local()
+_pid = None
+_clients = {}
+
+
+def _config(service=None):
+  # SigV4 is the default for the other services; S3 needs it asked for
+  # (presigned URLs and POST policies)
+  signature_version = 's3v4' if service == 's3' else None
+  return Config(
+    region_name=app.config['AWS_REGION_NAME'],
+    signature_version=signature_version,
+    max_pool_connections=app.config['AWS_MAX_POOL_CONNECTIONS'],
+    tcp_keepalive=app.config['AWS_TCP_KEEPALIVE'],
+    retries={
+      'max_attempts': app.config['AWS_MAX_ATTEMPTS'],
+      'mode': 'standard'
+    })
+
+
+"""Shared client for an AWS service (e.g. 's3', 'sns')
+"""
+def client(service):
+  global _pid
+  with _lock:
+    if _pid != os.getpid():
+      _clients.clear()
+      _pid = os.getpid()
+    if service not in _clients:
+      _clients[service] = boto3.session.Session().client(service,
+        config=_config(service))
+    return _clients[service]
+
+
+"""DynamoDB table for the calling thread
+"""
+def table(name):
+  if getattr(_local, 'pid', None) != os.getpid():
+    _local.pid = os.getpid()
+    _local.dynamodb = boto3.session.Session().resource('dynamodb',
+      config=_config())
+    _local.tables = {}
+  if name not in _local.tables:
+    _local.tables[name] = _local.dynamodb.Table(name)
+  return _local.tables[name]
+
+### EOF
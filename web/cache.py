@@ -0,0 +1,50 @@
+# cache.py
+#
+# Short-lived in-process caches for the GAS web server
+#
+# Entries expire after a fixed TTL and are grouped by owner (e.g. user ID)
+# so every entry of one user can be dropped when their data changes.
+##
+
+import time
+from threading import Lock
+
+
+class TTLCache(object):
+
+  def __init__(self, ttl, max_entries=10000):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.entries = {}
+    self.lock = Lock()
+
+  def get(self, owner, key):
+    with self.lock:
+      entry = self.entries.get((owner, key))
+      if entry is None:
+        return None
+      if entry[0] < time.time():
+        del self.entries[(owner, key)]
+        return None
+      return entry[1]
+
+  def set(self, owner, key, value):
+    with self.lock:
+      if len(self.entries) >= self.max_entries:
+        self.expire()
+      if len(self.entries) >= self.max_entries:
+        # Still full of live entries; start over rather than grow unbounded
+        self.entries.clear()
+      self.entries[(owner, key)] = (time.time() + self.ttl, value)
+
+  def invalidate(self, owner):
+    with self.lock:
+      for entry_key in [k for k in self.entries if k[0] == owner]:
+        del self.entries[entry_key]
+
+  def expire(self):
+    now = time.time()
+    for entry_key in [k for k, v in self.entries.items() if v[0] < now]:
+      del self.entries[entry_key]
+
+### EOF
@@ -10,11 +10,81 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import stat
+import time
 import boto3
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
 basedir = os.path.abspath(os.path.dirname(__file__))
+# Local state of the web server (e.g. the job outbox), outside the checkout
+datadir = os.environ['GAS_DATA_DIR'] \
+  if ('GAS_DATA_DIR' in os.environ) else os.path.expanduser('~/.local/share/gas')
+
+# Outside the checkout: the per-user runtime directory (tmpfs, cleared at
+# logout/reboot) when there is one, else the user's cache directory
+SECRETS_CACHE_PATH = os.environ['GAS_SECRETS_CACHE_PATH'] \
+  if ('GAS_SECRETS_CACHE_PATH' in os.environ) else \
+  os.path.join(os.environ['XDG_RUNTIME_DIR'], 'gas_secrets_cache') \
+  if ('XDG_RUNTIME_DIR' in os.environ) else \
+  os.path.expanduser('~/.cache/gas/secrets_cache')
+SECRETS_CACHE_TTL = int(os.environ['GAS_SECRETS_CACHE_TTL']) \
+  if ('GAS_SECRETS_CACHE_TTL' in os.environ) else 3600
+
+"""Secrets from AWS Secrets Manager as {secret ID: parsed JSON}
+Cached for SECRETS_CACHE_TTL seconds in a file only this user can read, so
+most worker boots need no Secrets Manager calls; on a miss all secrets are
+fetched concurrently.
+"""
+def load_secrets(region_name, secret_ids):
+  start = time.time()
+  secrets = read_secrets_cache(secret_ids)
+  source = 'cache'
+  if secrets is None:
+    source = 'Secrets Manager'
+    asm = boto3.client('secretsmanager', region_name=region_name)
+
+    def fetch(secret_id):
+      try:
+        asm_response = asm.get_secret_value(SecretId=secret_id)
+      except ClientError as e:
+        print(f"Unable to retrieve {secret_id} from ASM: {e}")
+        raise e
+      return json.loads(asm_response['SecretString'])
+
+    with ThreadPoolExecutor(max_workers=len(secret_ids)) as pool:
+      secrets = dict(zip(secret_ids, pool.map(fetch, secret_ids)))
+    write_secrets_cache(secrets)
+  print(f"Loaded secrets from {source} in {(time.time() - start) * 1000:.0f} ms")
+  return secrets
+
+def read_secrets_cache(secret_ids):
+  try:
+    st = os.stat(SECRETS_CACHE_PATH)
+    # Ignore a cache others could have read or written
+    if st.st_uid != os.getuid() or (st.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+      return None
+    if time.time() - st.st_mtime > SECRETS_CACHE_TTL:
+      return None
+    with open(SECRETS_CACHE_PATH) as f:
+      secrets = json.load(f)
+  except (OSError, ValueError):
+    return None
+  if not all(secret_id in secrets for secret_id in secret_ids):
+    return None
+  return secrets
+
+def write_secrets_cache(secrets):
+  tmp_path = f"{SECRETS_CACHE_PATH}.{os.getpid()}.tmp"
+  try:
+    os.makedirs(os.path.dirname(SECRETS_CACHE_PATH), mode=0o700, exist_ok=True)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+      json.dump(secrets, f)
+    os.replace(tmp_path, SECRETS_CACHE_PATH)
+  except OSError as e:
+    print(f"Unable to cache secrets: {e}")
 
 class Config(object):
   GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
@@ -37,25 +107,22 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+  # Shared AWS clients (see aws.py): pool size per worker process, TCP
+  # keep-alive and retry attempts
+  AWS_MAX_POOL_CONNECTIONS = 20
+  AWS_TCP_KEEPALIVE = True
+  AWS_MAX_ATTEMPTS = 3
+
+  # Get various credentials from AWS Secrets Manager (or the local cache)
+  secrets = load_secrets(AWS_REGION_NAME,
+    ['gas/web_server', 'rds/accounts_database', 'globus/auth_client'])
 
   # Get Flask application secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Flask secret from ASM: {e}")
-    raise e
+  flask_secret = secrets['gas/web_server']
   SECRET_KEY = flask_secret['flask_secret_key']
 
   # Get RDS secret and construct database URI
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-    raise e
+  rds_secret = secrets['rds/accounts_database']
 
   SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
   SQLALCHEMY_DATABASE_URI = "postgresql://" + \
@@ -65,12 +132,7 @@ class Config(object):
   SQLALCHEMY_TRACK_MODIFICATIONS = True
 
   # Get the Globus Auth client ID and secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-    raise e
+  globus_auth = secrets['globus/auth_client']
 
   # Set the Globus Auth client ID and secret
   GAS_CLIENT_ID = globus_auth['gas_client_id']
@@ -97,9 +159,60 @@ class Config(object):
     'arn:aws:sns:us-east-1:659248683008:candrle_job_results'
   AWS_SNS_GLACIER_RESTORE_TOPIC = \
     'arn:aws:sns:us-east-1:659248683008:candrle_glacier_restore'
+  # Optional topic the annotator publishes RUNNING transitions to
+  AWS_SNS_JOB_STATUS_TOPIC = os.environ['AWS_SNS_JOB_STATUS_TOPIC'] \
+    if ('AWS_SNS_JOB_STATUS_TOPIC' in os.environ) else None
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "candrle_annotations"
+  # GSI on user_id (partition) and submit_time (sort), projecting at least
+  # job_id, input_file_name and job_status
+  AWS_DYNAMODB_USER_INDEX = "user_id_submit_time_index"
+
+  # Annotations list: jobs per page and seconds a page is cached
+  ANNOTATIONS_PAGE_SIZE = 25
+  ANNOTATIONS_CACHE_TTL = 30
+
+  # Job submission outbox (see outbox.py): SQLite file on local disk,
+  # seconds between checks for due retries, longest retry delay, and how
+  # long a dispatcher may hold a job before another one retries it
+  OUTBOX_PATH = datadir + "/outbox.db"
+  OUTBOX_POLL_INTERVAL = 5
+  OUTBOX_RETRY_MAX_DELAY = 300
+  OUTBOX_CLAIM_SECONDS = 60
+
+  # Log viewer: bytes per page, and per chunk streamed from S3
+  LOG_PAGE_BYTES = 64 * 1024
+  LOG_CHUNK_BYTES = 8 * 1024
+
+  # Result preview: records per page, bytes scanned per request at most,
+  # gap between indexed ranges fetched with one GET, and how long a
+  # result's index is cached
+  PREVIEW_PAGE_RECORDS = 100
+  PREVIEW_SCAN_BYTES = 64 * 1024 * 1024
+  PREVIEW_COALESCE_BYTES = 64 * 1024
+  PREVIEW_INDEX_CACHE_TTL = 600
+
+  # Seconds a worker keeps a copy of a profile, and a user's role claim in
+  # the session is trusted before it is checked again
+  PROFILE_CACHE_TTL = 300
+  PROFILE_CLAIM_TTL = 300
+
+  # Live job status (see job_events.py): events shared by the workers on a
+  # host, how often streams check them, heartbeat and stream lifetime, the
+  # long-poll wait, how old an event may get before DynamoDB is read again
+  # and how long events of idle jobs are kept (seconds). Streams and long
+  # polls each hold a worker thread: at most JOB_EVENTS_MAX_WAITING of them
+  # per worker (keep it below the gunicorn --threads count)
+  JOB_EVENTS_DIR = datadir + "/events"
+  JOB_EVENTS_CHECK_INTERVAL = 0.5
+  JOB_EVENTS_HEARTBEAT = 15
+  JOB_EVENTS_STREAM_SECONDS = 300
+  JOB_EVENTS_RETRY_MS = 3000
+  JOB_EVENTS_LONG_POLL = 25
+  JOB_EVENTS_REFRESH = 60
+  JOB_EVENTS_RETENTION = 86400
+  JOB_EVENTS_MAX_WAITING = 8
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "candrle@mpcs-cc.com"
@@ -0,0 +1,79 @@
+# job_events.py
+#
+# Job status events shared by the web server's worker processes
+#
+# The SNS endpoint writes the latest status of a job to a small file in
+# JOB_EVENTS_DIR; status streams of any worker on the host watch that file
+# (a stat every JOB_EVENTS_CHECK_INTERVAL seconds) instead of polling
+# DynamoDB for every open page.
+##
+
+import os
+import json
+import time
+
+from gas import app
+
+
+def _path(job_id):
+  return os.path.join(app.config['JOB_EVENTS_DIR'], os.path.basename(job_id))
+
+
+"""Record the current status of a job and wake its watchers
+"""
+def publish(job_id, event):
+  os.makedirs(app.config['JOB_EVENTS_DIR'], exist_ok=True)
+  tmp_path = f"{_path(job_id)}.{os.getpid()}.tmp"
+  with open(tmp_path, 'w') as f:
+    json.dump(event, f)
+  os.replace(tmp_path, _path(job_id))
+
+
+"""Latest published event of a job as (version, event), or (None, None)
+"""
+def latest(job_id):
+  try:
+    version = os.stat(_path(job_id)).st_mtime_ns
+    with open(_path(job_id)) as f:
+      return version, json.load(f)
+  except (OSError, ValueError):
+    return None, None
+
+
+"""Waits up to timeout seconds for an event newer than version
+Returns (version, event), or (version, None) on timeout
+"""
+def wait(job_id, version, timeout):
+  deadline = time.time() + timeout
+  while True:
+    try:
+      current = os.stat(_path(job_id)).st_mtime_ns
+    except OSError:
+      current = None
+    if current is not None and current != version:
+      new_version, event = latest(job_id)
+      if event is not None:
+        return new_version, event
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return version, None
+    time.sleep(min(remaining, app.config['JOB_EVENTS_CHECK_INTERVAL']))
+
+
+"""Removes events of jobs not updated for JOB_EVENTS_RETENTION seconds
+"""
+def expire():
+  cutoff = time.time() - app.config['JOB_EVENTS_RETENTION']
+  try:
+    names = os.listdir(app.config['JOB_EVENTS_DIR'])
+  except OSError:
+    return
+  for name in names:
+    path = os.path.join(app.config['JOB_EVENTS_DIR'], name)
+    try:
+      if os.stat(path).st_mtime < cutoff:
+        os.remove(path)
+    except OSError:
+      pass
+
+### EOF
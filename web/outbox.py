@@ -0,0 +1,172 @@
+# outbox.py
+#
+# Durable local outbox for annotation job submissions
+#
+# A submission is committed to a SQLite file on local disk and the request
+# returns; a dispatcher thread in each worker process then writes the job
+# to DynamoDB and publishes it to the job request topic, retrying with
+# backoff while AWS is slow or unavailable. Rows are claimed before they
+# are sent, so workers sharing the file do not send the same job twice.
+##
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from botocore.exceptions import ClientError
+
+from gas import app
+import aws
+
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_pid = None
+
+SCHEMA = '''create table if not exists outbox (
+  job_id text primary key,
+  user_id text not null,
+  payload text not null,
+  stage text not null default 'put',
+  attempts integer not null default 0,
+  next_attempt real not null default 0,
+  claimed_until real not null default 0,
+  created real not null
+)'''
+
+
+def _connect():
+  os.makedirs(os.path.dirname(app.config['OUTBOX_PATH']), exist_ok=True)
+  conn = sqlite3.connect(app.config['OUTBOX_PATH'], timeout=30,
+    isolation_level=None)
+  conn.execute('pragma journal_mode=wal')
+  conn.execute('pragma synchronous=full')
+  conn.execute(SCHEMA)
+  return conn
+
+
+"""Durably queue a job for submission; returns once it is on disk
+"""
+def enqueue(job):
+  conn = _connect()
+  try:
+    conn.execute('insert or ignore into outbox (job_id, user_id, payload, '
+      'created) values (?, ?, ?, ?)',
+      (job['job_id'], job['user_id'], json.dumps(job), time.time()))
+  finally:
+    conn.close()
+  start()
+  _wakeup.set()
+
+
+"""A job still waiting in the outbox, or None
+"""
+def pending_job(job_id):
+  conn = _connect()
+  try:
+    row = conn.execute('select payload from outbox where job_id = ?',
+      (job_id,)).fetchone()
+  finally:
+    conn.close()
+  return json.loads(row[0]) if row else None
+
+
+"""Jobs of a user still waiting in the outbox, newest first
+"""
+def pending_jobs(user_id):
+  conn = _connect()
+  try:
+    rows = conn.execute('select payload from outbox where user_id = ? '
+      'order by created desc', (user_id,)).fetchall()
+  finally:
+    conn.close()
+  return [json.loads(row[0]) for row in rows]
+
+
+"""Starts this process's dispatcher (again after a fork)
+"""
+def start():
+  global _pid
+  with _lock:
+    if _pid == os.getpid():
+      return
+    _pid = os.getpid()
+    threading.Thread(target=_dispatch_forever, daemon=True).start()
+
+
+def _dispatch_forever():
+  while True:
+    try:
+      while _dispatch_one():
+        pass
+    except Exception as e:
+      app.logger.error(f"Outbox dispatcher error: {e}")
+    _wakeup.wait(app.config['OUTBOX_POLL_INTERVAL'])
+    _wakeup.clear()
+
+
+def _claim(conn):
+  # Claim the oldest due row; a claim that is not released (e.g. the
+  # process died) expires and the row is sent again
+  now = time.time()
+  while True:
+    row = conn.execute('select job_id, payload, stage, attempts from outbox '
+      'where next_attempt <= ? and claimed_until <= ? order by created limit 1',
+      (now, now)).fetchone()
+    if row is None:
+      return None
+    claimed = conn.execute('update outbox set claimed_until = ? where '
+      'job_id = ? and claimed_until <= ?',
+      (now + app.config['OUTBOX_CLAIM_SECONDS'], row[0], now)).rowcount
+    if claimed:
+      return row
+
+
+def _dispatch_one():
+  conn = _connect()
+  try:
+    row = _claim(conn)
+    if row is None:
+      return False
+    job_id, payload, stage, attempts = row
+    job = json.loads(payload)
+    try:
+      if stage == 'put':
+        _put_job(job)
+        conn.execute("update outbox set stage = 'publish' where job_id = ?",
+          (job_id,))
+      _publish_job(job)
+      conn.execute('delete from outbox where job_id = ?', (job_id,))
+      app.logger.info(f"Submitted job {job_id}")
+    except Exception as e:
+      delay = min(app.config['OUTBOX_RETRY_MAX_DELAY'], 2 ** attempts)
+      app.logger.error(f"Unable to submit job {job_id}, retrying in {delay}s: {e}")
+      conn.execute('update outbox set attempts = attempts + 1, '
+        'next_attempt = ?, claimed_until = 0 where job_id = ?',
+        (time.time() + delay, job_id))
+    return True
+  finally:
+    conn.close()
+
+
+def _put_job(job):
+  # Only the first write counts: a retry must not reset a job the
+  # annotator has already picked up
+  try:
+    aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']).put_item(
+      Item=job, ConditionExpression='attribute_not_exists(job_id)')
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+
+
+def _publish_job(job):
+  #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
+  aws.client('sns').publish(
+    TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+    Message=json.dumps({'default': json.dumps(job)}),
+    MessageStructure='json'
+  )
+
+### EOF
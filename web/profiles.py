@@ -0,0 +1,66 @@
+# profiles.py
+#
+# Cached profile lookups for the GAS web server
+#
+# Profiles change rarely but are read on every premium-gated request, so
+# each worker keeps a read-only copy for PROFILE_CACHE_TTL seconds. Any
+# flush that inserts or updates a Profile (e.g. auth.update_profile) drops
+# the copy in the worker that made it. The user's role is also kept in the
+# signed session cookie, refreshed every PROFILE_CLAIM_TTL seconds, so role
+# checks usually need neither the cache nor the database.
+##
+
+import time
+from collections import namedtuple
+
+from flask import session
+from sqlalchemy import event
+
+from gas import app, db
+from models import Profile
+from cache import TTLCache
+
+CachedProfile = namedtuple('CachedProfile',
+  ['identity_id', 'name', 'email', 'institution', 'role'])
+
+profile_cache = TTLCache(app.config['PROFILE_CACHE_TTL'])
+
+
+"""Read-only copy of a user's profile, or None if there is none
+"""
+def get_profile(identity_id):
+  key = str(identity_id)
+  profile = profile_cache.get(key, 'profile')
+  if profile is None:
+    row = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+    if row is None:
+      return None
+    profile = CachedProfile(key, row.name, row.email, row.institution, row.role)
+    profile_cache.set(key, 'profile', profile)
+  return profile
+
+
+"""Role of the signed-in user, from the session claim while it is fresh
+"""
+def session_role():
+  checked = session.get('role_checked', 0)
+  if session.get('role') and time.time() - checked < app.config['PROFILE_CLAIM_TTL']:
+    return session['role']
+  profile = get_profile(session.get('primary_identity'))
+  if profile is None:
+    return None
+  set_session_role(profile.role)
+  return profile.role
+
+
+def set_session_role(role):
+  session['role'] = role
+  session['role_checked'] = time.time()
+
+
+@event.listens_for(Profile, 'after_insert')
+@event.listens_for(Profile, 'after_update')
+def invalidate_profile(mapper, connection, target):
+  profile_cache.invalidate(str(target.identity_id))
+
+### EOF
@@ -0,0 +1,189 @@
+# result_index.py
+#
+# Region and filter queries over annotated results in S3
+#
+# An annotated result (.annot.vcf) may have a sidecar index (.annot.vcf.idx)
+# listing, for each chromosome and bin of positions, the byte ranges of
+# the records in that bin:
+#
+#   ##gas-index=1
+#   ##bin_size=16384
+#   ##header_bytes=<offset of the first record>
+#   ##size=<size of the result>
+#   <chrom>\t<bin>\t<start>\t<end>\t<records>
+#
+# Region queries then fetch only those ranges with ranged GETs; other
+# queries scan the records from the start. Either way records are read as
+# a stream and reading stops once a page of matches is complete, so a page
+# costs the bytes up to its last match, not the whole result. Pages are
+# continued from a byte offset.
+##
+
+from botocore.exceptions import ClientError
+
+from gas import app
+from cache import TTLCache
+
+index_cache = TTLCache(app.config['PREVIEW_INDEX_CACHE_TTL'])
+
+
+class ResultIndex(object):
+
+  def __init__(self, bin_size, header_bytes, size, bins):
+    self.bin_size = bin_size
+    self.header_bytes = header_bytes
+    self.size = size
+    # chrom -> [(bin, start, end), ...] in file order
+    self.bins = bins
+
+  """Byte ranges holding the records of chrom between start and end
+  (inclusive, either may be None), merged and in file order
+  """
+  def ranges(self, chrom, start=None, end=None):
+    first_bin = (start // self.bin_size) if start is not None else None
+    last_bin = (end // self.bin_size) if end is not None else None
+    ranges = []
+    for (bin, range_start, range_end) in self.bins.get(chrom, []):
+      if first_bin is not None and bin < first_bin:
+        continue
+      if last_bin is not None and bin > last_bin:
+        continue
+      ranges.append([range_start, range_end])
+    ranges.sort()
+    merged = []
+    for range_start, range_end in ranges:
+      if merged and range_start <= merged[-1][1] + app.config['PREVIEW_COALESCE_BYTES']:
+        merged[-1][1] = max(merged[-1][1], range_end)
+      else:
+        merged.append([range_start, range_end])
+    return [tuple(r) for r in merged]
+
+
+def parse_index(text):
+  meta = {}
+  bins = {}
+  for line in text.splitlines():
+    if line.startswith('##'):
+      key, _, value = line[2:].partition('=')
+      meta[key] = value
+    elif line.strip():
+      chrom, bin, start, end = line.split('\t')[:4]
+      bins.setdefault(chrom, []).append((int(bin), int(start), int(end)))
+  if meta.get('gas-index') != '1':
+    raise ValueError('Unsupported result index')
+  return ResultIndex(int(meta['bin_size']), int(meta['header_bytes']),
+    int(meta['size']), bins)
+
+
+"""Index of a result, or None if it has none (e.g. results annotated
+before indexes were written)
+"""
+def load_index(s3, bucket, key):
+  index = index_cache.get(bucket, key)
+  if index is not None:
+    return index or None
+  try:
+    response = s3.get_object(Bucket=bucket, Key=key)
+    index = parse_index(response['Body'].read().decode('utf-8'))
+  except ClientError as e:
+    if e.response['Error']['Code'] not in ['NoSuchKey', 'AccessDenied']:
+      raise
+    index = False
+  except ValueError as e:
+    app.logger.warning(f"Ignoring result index {key}: {e}")
+    index = False
+  index_cache.set(bucket, key, index)
+  return index or None
+
+
+"""Records (end offset, line) read from ranges (start, end) of the object,
+skipping anything before offset; an end of None reads to the end
+"""
+def read_records(s3, bucket, key, ranges, offset=0):
+  for range_start, range_end in ranges:
+    if range_end is not None and range_end <= offset:
+      continue
+    range_start = max(range_start, offset)
+    byte_range = f'bytes={range_start}-' + \
+      (str(range_end - 1) if range_end is not None else '')
+    try:
+      response = s3.get_object(Bucket=bucket, Key=key, Range=byte_range)
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'InvalidRange':
+        return
+      raise
+    body = response['Body']
+    position = range_start
+    try:
+      for line in body.iter_lines(keepends=True):
+        position += len(line)
+        yield position, line.decode('utf-8', errors='replace').rstrip('\r\n')
+    finally:
+      body.close()
+
+
+"""Whether a VCF record matches a query: chrom, start and end (a region),
+genes (any name/name2 annotation) and info (KEY=VALUE items or KEY flags,
+all of which must be present)
+"""
+def matches(fields, query):
+  if len(fields) < 8:
+    return False
+  if query.get('chrom') and fields[0] != query['chrom']:
+    return False
+  if query.get('start') is not None or query.get('end') is not None:
+    try:
+      pos = int(fields[1])
+    except ValueError:
+      return False
+    if query.get('start') is not None and pos < query['start']:
+      return False
+    if query.get('end') is not None and pos > query['end']:
+      return False
+
+  # The gadAll stage writes its records with '\t ' between fields
+  items = [item.strip() for item in fields[7].strip().split(';')]
+  if query.get('genes'):
+    names = set([item.split('=', 1)[1] for item in items
+      if item.startswith('name=') or item.startswith('name2=')])
+    if not names.intersection(query['genes']):
+      return False
+  for condition in query.get('info', []):
+    if '=' in condition:
+      if condition not in items:
+        return False
+    elif not any(item == condition or item.startswith(condition + '=')
+      for item in items):
+      return False
+  return True
+
+
+"""One page of records matching query, starting at byte offset
+Returns (records as lists of fields, offset to continue from or None)
+"""
+def query_result(s3, bucket, key, query, offset=0, index=None):
+  if index is not None and query.get('chrom'):
+    ranges = index.ranges(query['chrom'], query.get('start'), query.get('end'))
+  elif index is not None:
+    ranges = [(index.header_bytes, index.size)]
+  else:
+    ranges = [(0, None)]
+
+  page_size = app.config['PREVIEW_PAGE_RECORDS']
+  scan_limit = offset + app.config['PREVIEW_SCAN_BYTES']
+  records = []
+  position = offset
+  for position, line in read_records(s3, bucket, key, ranges, offset):
+    if line.startswith('#') or not line:
+      continue
+    fields = [field.strip() for field in line.split('\t')]
+    if matches(fields, query):
+      records.append(fields)
+      if len(records) == page_size:
+        return records, position
+    if position >= scan_limit:
+      # Scanned enough for one request; the next page carries on from here
+      return records, position
+  return records, None
+
+### EOF
@@ -19,6 +19,7 @@ fi
   --log-file=$LOG_TARGET \
   --log-level=debug \
   --workers=$GUNICORN_WORKERS \
+  --threads=${GUNICORN_THREADS:-16} \
   --certfile=$SSL_CERT_PATH \
   --keyfile=$SSL_KEY_PATH \
   --bind=$GAS_APP_HOST:$GAS_HOST_PORT gas:app
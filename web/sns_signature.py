@@ -0,0 +1,82 @@
+# sns_signature.py
+#
+# Verification of messages posted by SNS to an HTTP/S endpoint
+#
+# SNS signs every message with the private key of a certificate it hosts
+# at SigningCertURL. A message is accepted only if that URL is an SNS
+# endpoint over HTTPS and the signature over the message's fields checks
+# out with the certificate's public key.
+# https://docs.aws.amazon.com/sns/latest/dg/sns-verify-signature-of-message.html
+##
+
+import re
+import base64
+import urllib.request
+from urllib.parse import urlparse
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from gas import app
+from cache import TTLCache
+
+# Signing certificates rarely change; keep them for a day
+certificate_cache = TTLCache(24 * 60 * 60, max_entries=100)
+
+SNS_HOST = re.compile(r'^sns\.[a-z0-9-]+\.amazonaws\.com(\.cn)?$')
+
+# Fields covered by the signature, in signing order
+SIGNED_FIELDS = {
+  'Notification': ['Message', 'MessageId', 'Subject', 'Timestamp',
+    'TopicArn', 'Type'],
+  'SubscriptionConfirmation': ['Message', 'MessageId', 'SubscribeURL',
+    'Timestamp', 'Token', 'TopicArn', 'Type'],
+  'UnsubscribeConfirmation': ['Message', 'MessageId', 'SubscribeURL',
+    'Timestamp', 'Token', 'TopicArn', 'Type']
+}
+
+HASHES = {'1': hashes.SHA1, '2': hashes.SHA256}
+
+
+def _certificate(url):
+  certificate = certificate_cache.get('sns', url)
+  if certificate is None:
+    with urllib.request.urlopen(url, timeout=5) as response:
+      certificate = x509.load_pem_x509_certificate(response.read(),
+        default_backend())
+    certificate_cache.set('sns', url, certificate)
+  return certificate
+
+
+"""Whether message (the parsed JSON body of an SNS request) was signed by SNS
+"""
+def verify(message):
+  fields = SIGNED_FIELDS.get(message.get('Type'))
+  algorithm = HASHES.get(message.get('SignatureVersion'))
+  if fields is None or algorithm is None or not message.get('Signature'):
+    return False
+
+  certificate_url = message.get('SigningCertURL', '')
+  url = urlparse(certificate_url)
+  if url.scheme != 'https' or not SNS_HOST.match(url.hostname or '') or \
+    not url.path.endswith('.pem'):
+    app.logger.warning(f"Untrusted SNS signing certificate {certificate_url}")
+    return False
+
+  string_to_sign = ''.join([f"{field}\n{message[field]}\n"
+    for field in fields if field in message])
+  try:
+    _certificate(certificate_url).public_key().verify(
+      base64.b64decode(message['Signature']),
+      string_to_sign.encode('utf-8'), padding.PKCS1v15(), algorithm())
+  except InvalidSignature:
+    return False
+  except Exception as e:
+    app.logger.error(f"Unable to verify SNS message: {e}")
+    return False
+  return True
+
+### EOF
@@ -11,19 +11,46 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import uuid
 import time
 import json
+import codecs
+import re
+import threading
 from datetime import datetime
 
-import boto3
 from boto3.dynamodb.conditions import Key
-from botocore.client import Config
 from botocore.exceptions import ClientError
 
-from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+from flask import (abort, flash, jsonify, redirect, render_template,
+  request, Response, session, stream_with_context, url_for)
+from itsdangerous import BadSignature, URLSafeSerializer
 
 from gas import app, db
+from cache import TTLCache
+import aws
+import job_events
+import profiles
+import result_index
+import outbox
+import sns_signature
 from decorators import authenticated, is_premium
-from auth import get_profile, update_profile
+from auth import update_profile
+
+# Pages of each user's annotations list, keyed by cursor
+annotations_cache = TTLCache(app.config['ANNOTATIONS_CACHE_TTL'])
+# Cursors are the signed LastEvaluatedKey of the previous page
+cursor_serializer = URLSafeSerializer(app.config['SECRET_KEY'],
+  salt='annotations-cursor')
+# Job statuses that do not change any more
+FINAL_STATUSES = ['COMPLETED', 'FAILED']
+# Requests of this worker waiting on job events (streams and long polls);
+# each holds a worker thread, so the rest are left for other requests
+job_event_slots = threading.BoundedSemaphore(app.config['JOB_EVENTS_MAX_WAITING'])
+
+
+# Keep each worker's outbox dispatcher running, also for jobs queued
+# before a restart
+@app.before_request
+def start_outbox():
+  outbox.start()
 
 
 """Start annotation request
@@ -36,10 +63,8 @@ but you can replace the code below with your own if you prefer.
 @app.route('/annotate', methods=['GET'])
 @authenticated
 def annotate():
-  # Create a session client to the S3 service
-  s3 = boto3.client('s3',
-    region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
+  # Shared S3 client (signs with SigV4)
+  s3 = aws.client('s3')
 
   bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   user_id = session['primary_identity']
@@ -99,7 +124,9 @@ def create_annotation_job_request():
 
   #Extract user id
   user_id = session.get('primary_identity')
-  profile = get_profile(identity_id=user_id)
+  #Cached copy; the role comes from the session claim, which subscribe and
+  #unsubscribe set directly
+  profile = profiles.get_profile(user_id)
 
   # Extract the job ID from the S3 key
   file_name = s3_key.split('~')[1]
@@ -111,7 +138,7 @@ def create_annotation_job_request():
   data = { "job_id": job_id,
             "user_id": user_id,
             "username": profile.name,
-            "user_role": profile.role,
+            "user_role": profiles.session_role(),
             "email": profile.email,
             "input_file_name": file_name,
             "s3_inputs_bucket": bucket_name,
@@ -122,58 +149,82 @@ def create_annotation_job_request():
             }
   print(f'Job Information: {data}')
 
-  #Add Item to Table
-  dynamo = boto3.resource('dynamodb')
-  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  #Queue the job; the outbox writes it to DynamoDB and publishes it to the
+  #job request topic in the background, retrying until AWS accepts it
   try:
-      table.put_item(Item=data)
-      print(f'Job Information Added to Table {table}')
+    outbox.enqueue(data)
   except Exception as e:
-    app.logger.error(f"Unable to add job information to table {table}: {e}")
+    app.logger.error(f"Unable to queue job {job_id}: {e}")
     return abort(500)
+  annotations_cache.invalidate(user_id)
+  job_events.publish(job_id, {'job_id': job_id, 'user_id': user_id,
+    'job_status': 'PENDING'})
 
-  #Send message to request queue
-  #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/publish.html
-  sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
-  sns_message = json.dumps({'default': json.dumps(data)})
-  try:
-      sns_topic_response = sns.publish(
-          TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
-          Message=sns_message,
-          MessageStructure='json'
-      )
-      return render_template('annotate_confirm.html', job_id=job_id)
-  except Exception as e:
-    app.logger.error(f"Unable to publish sns message: {e}")
-    return abort(500)
+  return render_template('annotate_confirm.html', job_id=job_id)
 
 
-"""List all annotations for the user
+"""List all annotations for the user, newest first
+One page per request; the cursor query argument continues from the
+previous page. Pages are cached briefly per user.
 """
 @app.route('/annotations', methods=['GET'])
 @authenticated
 def annotations_list():
 
-  dynamo = boto3.resource('dynamodb')
-  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   user_id = session.get('primary_identity')
+  cursor = request.args.get('cursor')
+  start_key = None
+  if cursor:
+    try:
+      start_key = cursor_serializer.loads(cursor)
+    except BadSignature:
+      app.logger.warning(f"Invalid annotations cursor from user {user_id}")
+      return redirect(url_for('annotations_list'))
+    if start_key.get('user_id') != user_id:
+      app.logger.error(f"Unauthorized cursor use by user {user_id}")
+      return abort(403)
+
+  page = annotations_cache.get(user_id, cursor)
+  if page is None:
+    table = aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    query = {
+      'IndexName': app.config['AWS_DYNAMODB_USER_INDEX'],
+      'KeyConditionExpression': Key('user_id').eq(user_id),
+      'ProjectionExpression': 'job_id, input_file_name, submit_time, job_status',
+      'ScanIndexForward': False,
+      'Limit': app.config['ANNOTATIONS_PAGE_SIZE']
+    }
+    if start_key:
+      query['ExclusiveStartKey'] = start_key
 
-  try:
+    try:
       #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/client/query.html
-      data = table.query(
-            IndexName='user_id_index',
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('user_id').eq(user_id),
-            ProjectionExpression='job_id, input_file_name, submit_time, job_status'
-          )
-  except Exception as e:
-    app.logger.error(f"Unable to get user annotations: {e}")
-    return abort(500)
+      data = table.query(**query)
+    except Exception as e:
+      app.logger.error(f"Unable to get user annotations: {e}")
+      return abort(500)
 
-  #Make Times Human Readable
-  for job in data['Items']:
-    job['submit_time'] = datetime.fromtimestamp(float(job['submit_time'])).strftime('%Y-%m-%d %H:%M')
-  
-  return render_template('annotations.html', annotations=data['Items'])
+    #Make Times Human Readable
+    for job in data['Items']:
+      job['submit_time'] = datetime.fromtimestamp(float(job['submit_time'])).strftime('%Y-%m-%d %H:%M')
+
+    next_cursor = None
+    if 'LastEvaluatedKey' in data:
+      next_cursor = cursor_serializer.dumps(data['LastEvaluatedKey'])
+    page = {'annotations': data['Items'], 'next_cursor': next_cursor}
+    annotations_cache.set(user_id, cursor, page)
+
+  annotations = page['annotations']
+  if cursor is None:
+    #Newest jobs may still be on their way to DynamoDB
+    listed = set([job['job_id'] for job in annotations])
+    queued = [dict(job, submit_time=datetime.fromtimestamp(
+        float(job['submit_time'])).strftime('%Y-%m-%d %H:%M'))
+      for job in outbox.pending_jobs(user_id) if job['job_id'] not in listed]
+    annotations = queued + annotations
+
+  return render_template('annotations.html', annotations=annotations,
+    next_cursor=page['next_cursor'], first_page=(cursor is None))
 
 
 """Display details of a specific annotation job
@@ -182,8 +233,7 @@ def annotations_list():
 @authenticated
 def annotation_details(id):
 
-  dynamo = boto3.resource('dynamodb')
-  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  table = aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   user_id = session.get('primary_identity')
 
   try:
@@ -193,15 +243,19 @@ def annotation_details(id):
     app.logger.error(f"Error fetching job data: {e}")
     return abort(500, description='Job not found')
 
+  if not job_data:
+    #Submitted but not yet written to DynamoDB
+    job_data = outbox.pending_job(id)
+
   if not job_data:
     app.logger.error(f"Job ID {id} not found")
-    return abord(404)
+    return abort(404)
 
   if job_data['user_id'] != user_id:
     app.logger.error(f"Unauthorized access by user {user_id} for job {id}")
     return abort(403, description='Unauthorized user')
   
-  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  s3 = aws.client('s3')
   bucket = app.config['AWS_S3_RESULTS_BUCKET']
 
   result_file_url = None
@@ -246,21 +300,285 @@ def annotation_details(id):
 
   
 
-"""Display the log file contents for an annotation job
+"""Reads a job's status from DynamoDB and publishes it to this host's
+job events; returns the event, or None if the job does not exist
 """
-@app.route('/annotations/<id>/log', methods=['GET'])
+def refresh_job_status(job_id):
+  table = aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  job_data = table.get_item(Key={'job_id': job_id},
+    ProjectionExpression='job_id, user_id, job_status').get('Item')
+  if not job_data:
+    job_data = outbox.pending_job(job_id)
+  if not job_data:
+    return None
+  event = {'job_id': job_id, 'user_id': job_data['user_id'],
+    'job_status': job_data['job_status']}
+  job_events.publish(job_id, event)
+  return event
+
+
+"""Current status event of a job as (version, event): the last one
+published on this host, re-read from DynamoDB when missing or older than
+JOB_EVENTS_REFRESH seconds (covers notifications delivered to other hosts)
+"""
+def job_status_event(job_id):
+  version, event = job_events.latest(job_id)
+  if event is not None and (event['job_status'] in FINAL_STATUSES or
+    time.time() - version / 1e9 < app.config['JOB_EVENTS_REFRESH']):
+    return version, event
+
+  try:
+    event = refresh_job_status(job_id)
+  except Exception as e:
+    app.logger.error(f"Error fetching job status: {e}")
+    return abort(500)
+  if event is None:
+    return abort(404)
+  return job_events.latest(job_id)
+
+
+def status_payload(event):
+  return {'job_id': event['job_id'], 'job_status': event['job_status']}
+
+
+"""Stream status changes of an annotation job (Server-Sent Events)
+The stream ends when the job completes (or fails) or after
+JOB_EVENTS_STREAM_SECONDS; browsers reconnect on their own. With
+JOB_EVENTS_MAX_WAITING requests already waiting in this worker the answer
+is 503, and the page falls back to polling.
+"""
+@app.route('/annotations/<id>/events', methods=['GET'])
 @authenticated
-def annotation_log(id):
+def annotation_events(id):
+  user_id = session.get('primary_identity')
+  version, event = job_status_event(id)
+  if event['user_id'] != user_id:
+    app.logger.error(f"Unauthorized access by user {user_id} for job {id}")
+    return abort(403)
 
-  dynamo = boto3.resource('dynamodb')
-  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  if not job_event_slots.acquire(blocking=False):
+    return Response('Too many open status streams', status=503,
+      headers={'Retry-After': str(app.config['JOB_EVENTS_RETRY_MS'] // 1000)})
+
+  def stream(version, event):
+    yield f"retry: {app.config['JOB_EVENTS_RETRY_MS']}\n"
+    yield f"event: status\ndata: {json.dumps(status_payload(event))}\n\n"
+    deadline = time.time() + app.config['JOB_EVENTS_STREAM_SECONDS']
+    while event['job_status'] not in FINAL_STATUSES and time.time() < deadline:
+      version, update = job_events.wait(id, version,
+        app.config['JOB_EVENTS_HEARTBEAT'])
+      if update is None:
+        # Keeps proxies and load balancers from closing an idle stream
+        yield ": keep-alive\n\n"
+        if time.time() - version / 1e9 >= app.config['JOB_EVENTS_REFRESH']:
+          try:
+            refresh_job_status(id)
+          except Exception as e:
+            app.logger.error(f"Error fetching job status: {e}")
+      elif update['job_status'] != event['job_status']:
+        event = update
+        yield f"event: status\ndata: {json.dumps(status_payload(event))}\n\n"
+
+  response = Response(stream_with_context(stream(version, event)),
+    mimetype='text/event-stream')
+  # Called however the stream ends, also if it never started
+  response.call_on_close(job_event_slots.release)
+  response.headers['Cache-Control'] = 'no-cache'
+  response.headers['X-Accel-Buffering'] = 'no'
+  return response
+
+
+"""Polling fallback for clients without EventSource (or turned away)
+Returns once the job's status differs from ?since=, or after
+JOB_EVENTS_LONG_POLL seconds with the unchanged status; at once when
+JOB_EVENTS_MAX_WAITING requests are already waiting in this worker.
+"""
+@app.route('/annotations/<id>/status', methods=['GET'])
+@authenticated
+def annotation_status(id):
+  user_id = session.get('primary_identity')
+  version, event = job_status_event(id)
+  if event['user_id'] != user_id:
+    app.logger.error(f"Unauthorized access by user {user_id} for job {id}")
+    return abort(403)
+
+  since = request.args.get('since')
+  if event['job_status'] != since or not job_event_slots.acquire(blocking=False):
+    return jsonify(status_payload(event))
+  try:
+    deadline = time.time() + app.config['JOB_EVENTS_LONG_POLL']
+    while event['job_status'] == since and time.time() < deadline:
+      version, update = job_events.wait(id, version, deadline - time.time())
+      if update is not None:
+        event = update
+  finally:
+    job_event_slots.release()
+  return jsonify(status_payload(event))
+
+
+"""Job status notifications from SNS (HTTP/S subscription)
+Subscribed to the job results topic and, if configured, the job status
+topic. Requests not signed by SNS are refused; the message only says
+which job changed and its status is read back from DynamoDB.
+"""
+@app.route('/notifications/jobs', methods=['POST'])
+def job_status_notification():
+  try:
+    message = json.loads(request.get_data(as_text=True))
+  except ValueError:
+    return abort(400)
+
+  topics = [app.config['AWS_SNS_JOB_COMPLETE_TOPIC'],
+    app.config['AWS_SNS_JOB_STATUS_TOPIC']]
+  if message.get('TopicArn') not in [topic for topic in topics if topic]:
+    app.logger.warning(f"Notification from unknown topic {message.get('TopicArn')}")
+    return abort(403)
+  if not sns_signature.verify(message):
+    app.logger.warning(f"Unsigned or forged notification for {message.get('TopicArn')}")
+    return abort(403)
+
+  message_type = request.headers.get('x-amz-sns-message-type')
+  if message_type == 'SubscriptionConfirmation':
+    try:
+      #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sns/client/confirm_subscription.html
+      aws.client('sns').confirm_subscription(TopicArn=message['TopicArn'],
+        Token=message['Token'])
+      app.logger.info(f"Confirmed subscription to {message['TopicArn']}")
+    except Exception as e:
+      app.logger.error(f"Unable to confirm SNS subscription: {e}")
+      return abort(500)
+    return '', 200
+
+  if message_type != 'Notification':
+    return '', 200
+
+  try:
+    job_id = json.loads(message['Message'])['job_id']
+  except (KeyError, ValueError) as e:
+    app.logger.error(f"Unexpected job notification: {e}")
+    return '', 200
+
+  try:
+    event = refresh_job_status(job_id)
+  except Exception as e:
+    app.logger.error(f"Error fetching job status: {e}")
+    return abort(500)
+  if event is not None:
+    annotations_cache.invalidate(event['user_id'])
+  job_events.expire()
+  return '', 200
+
+
+"""Preview an annotated result: matching records only, one page at a time
+Filters: region (chrom or chrom:start-end), gene (comma-separated names)
+and info (KEY=VALUE or KEY, may repeat). Region queries read just the
+indexed byte ranges of the result; ?format=json returns the page as JSON.
+"""
+@app.route('/annotations/<id>/preview', methods=['GET'])
+@authenticated
+def annotation_preview(id):
+
+  table = aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
   user_id = session.get('primary_identity')
-  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'])
-  bucket_name = app.config['AWS_S3_RESULTS_BUCKET']
-  
-  response = table.get_item(Key={'job_id': id})
-  job_data = response['Item']
-  file_name = job_data["s3_key_log_file"]
+
+  try:
+    job_data = table.get_item(Key={'job_id': id},
+      ProjectionExpression='user_id, job_status, complete_time, '
+        's3_key_result_file, s3_key_index_file').get('Item')
+  except Exception as e:
+    app.logger.error(f"Error fetching job data: {e}")
+    return abort(500)
+
+  if not job_data:
+    app.logger.error(f"Job ID {id} not found")
+    return abort(404)
+
+  if job_data['user_id'] != user_id:
+    app.logger.error(f"Unauthorized access by user {user_id} for job {id}")
+    return abort(403)
+
+  if job_data['job_status'] != 'COMPLETED' or 's3_key_result_file' not in job_data:
+    return redirect(url_for('annotation_details', id=id))
+
+  #Same limit as downloads: free users' results are archived after a while
+  if profiles.session_role() != 'premium_user' and \
+    (int(time.time()) - int(float(job_data['complete_time']))) > \
+      app.config['FREE_USER_DATA_RETENTION']:
+    return redirect(url_for('subscribe'))
+
+  query = {'start': None, 'end': None}
+  region = request.args.get('region', '').strip()
+  match = re.match(r'^([^:\s]+)(?::([\d,]+)(?:-([\d,]+))?)?$', region)
+  if match:
+    query['chrom'] = match.group(1)
+    if match.group(2):
+      query['start'] = int(match.group(2).replace(',', ''))
+      query['end'] = int((match.group(3) or match.group(2)).replace(',', ''))
+  query['genes'] = [gene.strip() for gene in request.args.get('gene', '').split(',')
+    if gene.strip()]
+  query['info'] = [item.strip() for item in request.args.getlist('info') if item.strip()]
+  offset = max(0, request.args.get('cursor', 0, type=int))
+
+  s3 = aws.client('s3')
+  bucket = app.config['AWS_S3_RESULTS_BUCKET']
+  result_key = job_data['s3_key_result_file']
+  try:
+    index = result_index.load_index(s3, bucket,
+      job_data.get('s3_key_index_file', result_key + '.idx'))
+    records, next_offset = result_index.query_result(s3, bucket, result_key,
+      query, offset, index)
+  except ClientError as e:
+    app.logger.error(f"Error reading result {result_key}: {e}")
+    if e.response['Error']['Code'] == 'NoSuchKey':
+      return abort(404)
+    return abort(500)
+
+  if request.args.get('format') == 'json':
+    return jsonify({'job_id': id, 'records': records, 'next_cursor': next_offset})
+
+  next_args = request.args.to_dict(flat=False)
+  next_args['cursor'] = next_offset
+  return render_template('annotation_preview.html', job_id=id,
+    records=records, region=region, gene=request.args.get('gene', ''),
+    info=query['info'], indexed=(index is not None),
+    next_url=(url_for('annotation_preview', id=id, **next_args)
+      if next_offset is not None else None))
+
+
+"""Render a template as a stream, so pages can start before all of their
+content (e.g. an S3 body) has been read
+https://flask.palletsprojects.com/en/2.0.x/patterns/streaming/
+"""
+def stream_template(template_name, **context):
+  app.update_template_context(context)
+  template = app.jinja_env.get_template(template_name)
+  return Response(stream_with_context(template.stream(context)))
+
+
+"""Text of an S3 body, read LOG_CHUNK_BYTES at a time
+"""
+def s3_text_chunks(body):
+  decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+  try:
+    for chunk in body.iter_chunks(app.config['LOG_CHUNK_BYTES']):
+      yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+  finally:
+    body.close()
+
+
+"""S3 key of a job's log file, after checking the job belongs to the user
+"""
+def owned_log_key(id):
+  table = aws.table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  user_id = session.get('primary_identity')
+
+  try:
+    job_data = table.get_item(Key={'job_id': id},
+      ProjectionExpression='user_id, s3_key_log_file').get('Item')
+  except Exception as e:
+    app.logger.error(f"Error fetching job data: {e}")
+    return abort(500)
 
   if not job_data:
     app.logger.error(f"Job ID {id} not found")
@@ -269,16 +587,97 @@ def annotation_log(id):
   if job_data['user_id'] != user_id:
     app.logger.error(f"Unauthorized User")
     return abort(403)
-  
+
+  if 's3_key_log_file' not in job_data:
+    return abort(404)
+  return job_data['s3_key_log_file']
+
+
+"""Display the log file contents for an annotation job
+One page of LOG_PAGE_BYTES at a time (?page=N, from 0), or the end of the
+log (?tail); only that byte range is read from S3 and it is streamed into
+the page as it arrives.
+"""
+@app.route('/annotations/<id>/log', methods=['GET'])
+@authenticated
+def annotation_log(id):
+
+  s3 = aws.client('s3')
+  bucket_name = app.config['AWS_S3_RESULTS_BUCKET']
+  file_name = owned_log_key(id)
+  page_bytes = app.config['LOG_PAGE_BYTES']
+
+  tail = 'tail' in request.args
+  page = max(0, request.args.get('page', 0, type=int))
+  if tail:
+    byte_range = f'bytes=-{page_bytes}'
+  else:
+    byte_range = f'bytes={page * page_bytes}-{(page + 1) * page_bytes - 1}'
 
   try:
-    log_file = s3.get_object(Bucket=bucket_name, Key=file_name)
-    log_contents = log_file['Body'].read().decode('utf-8')
+    #https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3/client/get_object.html
+    log_file = s3.get_object(Bucket=bucket_name, Key=file_name, Range=byte_range)
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'InvalidRange':
+      app.logger.error(f'Error accessing log file {e}')
+      return abort(500)
+    if page > 0:
+      # Past the end of the log
+      return redirect(url_for('annotation_log', id=id, tail=1))
+    # Empty log
+    return render_template('view_log.html', job_id=id, log_chunks=[],
+      page=0, pages=1, tail=tail, size=0)
   except Exception as e:
     app.logger.error(f'Error accessing log file {e}')
     return abort(500)
 
-  return render_template('view_log.html', log_file_contents=log_contents)
+  # ContentRange is "bytes <first>-<last>/<size>"
+  first, size = log_file['ContentRange'].split(' ')[1].split('/')
+  size = int(size)
+  page = int(first.split('-')[0]) // page_bytes
+  pages = max(1, -(-size // page_bytes))
+
+  return stream_template('view_log.html', job_id=id,
+    log_chunks=s3_text_chunks(log_file['Body']),
+    page=page, pages=pages, tail=tail, size=size)
+
+
+"""Stream the raw log file; honors a Range request header (e.g. for
+head/tail views from the command line)
+"""
+@app.route('/annotations/<id>/log/raw', methods=['GET'])
+@authenticated
+def annotation_log_raw(id):
+
+  s3 = aws.client('s3')
+  bucket_name = app.config['AWS_S3_RESULTS_BUCKET']
+  file_name = owned_log_key(id)
+
+  params = {'Bucket': bucket_name, 'Key': file_name}
+  if request.headers.get('Range'):
+    params['Range'] = request.headers['Range']
+  try:
+    log_file = s3.get_object(**params)
+  except ClientError as e:
+    if e.response['Error']['Code'] == 'InvalidRange':
+      return abort(416)
+    app.logger.error(f'Error accessing log file {e}')
+    return abort(500)
+
+  def stream(body):
+    try:
+      for chunk in body.iter_chunks(app.config['LOG_CHUNK_BYTES']):
+        yield chunk
+    finally:
+      body.close()
+
+  response = Response(stream(log_file['Body']), mimetype='text/plain')
+  response.headers['Accept-Ranges'] = 'bytes'
+  response.headers['Content-Length'] = str(log_file['ContentLength'])
+  if 'ContentRange' in log_file:
+    response.status_code = 206
+    response.headers['Content-Range'] = log_file['ContentRange']
+  return response
 
 
 
@@ -302,43 +701,29 @@ def subscribe():
     )
 
     # Update role in the session
-    session['role'] = "premium_user"
+    profiles.set_session_role("premium_user")
 
     # Request restoration of the user's data from Glacier
     # Add code here to initiate restoration of archived user data
     # Make sure you handle files not yet archived!
-    #Send message to request queue
+    #One restore event per user; the restore service expands it into the
+    #user's archived results, so this does not grow with the number of jobs
     user_id = session.get('primary_identity')
-    sns = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
-    dynamo = boto3.resource('dynamodb')
-    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-    
-    #Get all User jobs from DynamoDB
+    sns_message = json.dumps({'default': json.dumps({
+      'type': 'restore-user',
+      'user_id': user_id
+    })})
     try:
-      response = table.query(
-            IndexName='user_id_index',
-            KeyConditionExpression=boto3.dynamodb.conditions.Key('user_id').eq(user_id)
-          )
-      app.logger.info(f'User {user_id} jobs retrieved')
+      aws.client('sns').publish(
+        TopicArn=app.config['AWS_SNS_GLACIER_RESTORE_TOPIC'],
+        Message=sns_message,
+        MessageStructure='json'
+      )
+      app.logger.info(f'Restore requested for user {user_id}')
     except Exception as e:
-      app.logger.error(f"Unable to retrieve user {user_id}: {e}")
+      app.logger.error(f"Unable to initiate glacier restore: {e}")
       return abort(500)
 
-    #Restore Jobs in Glacier
-    for job in response['Items']:
-      if 'results_file_archive_id' in job.keys():
-        sns_message = json.dumps({'default': json.dumps(job)})
-        try:
-          sns_topic_response = sns.publish(
-              TopicArn=app.config['AWS_SNS_GLACIER_RESTORE_TOPIC'],
-              Message=sns_message,
-              MessageStructure='json'
-          )
-        except Exception as e:
-          app.logger.error(f"Unable to initiate glacier restore: {e}")
-          return abort(500)
-
-
     # Display confirmation page
     return render_template('subscribe_confirm.html') 
 
@@ -352,6 +737,7 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
+  profiles.set_session_role("free_user")
   return redirect(url_for('profile'))
 
 